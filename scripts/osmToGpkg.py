@@ -24,11 +24,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import subprocess
 import os
 import sys
 import argparse
 import re
+import json
+import hashlib
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from types import SimpleNamespace
 import math
 import time
@@ -36,42 +40,42 @@ import time
 # needs 'pip install packaging'
 from packaging.version import parse as parse_version
 
+# shared with the other scripts in this directory
+from toolRunner import runExecutable, runExecutables, removeFiles
 
-##############################################################################
 
+# rough size of the OSM driver node and way store per byte of input
+nodeStorePerPbfByte=1.5
+nodeStorePerXmlByte=0.15
 
-def runExecutable(args, stdinStr='', printCmdLine=False):
-    """
-    Runs program with parameters and returns the exit code and output as
-    a dictionary.
+# share of the available memory used for the node store by default
+nodeStoreMemoryShare=0.6
 
-    Args:
-        args: the program name and arguments as a string list
-        stdinStr: the string to be used as stdin input (you may have to add
-                  a newline to terminate)
+# OSM areas painted opaquely over the base layer by all style sheets
+coverAreaFilter="landuse IN ('allotments', 'brownfield', 'cemetery', "\
+"'commercial', 'construction', 'education', 'farmland', 'farmyard', "\
+"'forest', 'garden', 'grass', 'industrial', 'institutional', 'landfill', "\
+"'meadow', 'military', 'orchard', 'paddy', 'plant_nursery', 'port', "\
+"'quarry', 'railway', 'recreation_ground', 'religious', 'residential', "\
+"'retail', 'salt_pond', 'sports_centre', 'vineyard') OR natural IN "\
+"('bare_rock', 'beach', 'blockfield', 'glacier', 'grassland', 'heath', "\
+"'rock', 'sand', 'scree', 'scrub', 'shingle', 'tundra', 'water', "\
+"'wetland', 'wood') OR leisure IN ('golf_course', 'park', 'pitch', "\
+"'playground', 'stadium', 'track')"
 
-    Returns:
-        A SimpleNamespace with the members "exitCode" and "output" for
-        the exit code and merged stdout/err output text respectively encoded
-        using the OS device codepage
-    """
 
-    # we need this to get the console output formatted correctly
-    deviceEncoding=os.device_encoding(1)
+##############################################################################
 
-    if printCmdLine:
-        if stdinStr:
-            print('echo', stdinStr, '|', ' '.join(args))
-        else:
-            print(' '.join(args))
 
-    try:
-        output=subprocess.check_output(args, stderr=subprocess.STDOUT, 
-        input=stdinStr, shell=False, encoding=deviceEncoding)
-    except subprocess.CalledProcessError as exc:
-        return SimpleNamespace(exitCode=exc.returncode, output=exc.output)
-    else:
-        return SimpleNamespace(exitCode=0, output=output)
+class ConversionError(Exception):
+    """
+    Raised when a conversion stage fails. Carries the exit code of the
+    script next to the message.
+    """
+
+    def __init__(self, message, exitCode=3):
+        super().__init__(message)
+        self.exitCode=exitCode
 
 
 ##############################################################################
@@ -109,6 +113,34 @@ def parseCmdLine():
     cmdLineParser.add_argument('--baselayer', 
     default='ESA_WorldCover_10m_2021_v200_merged_0_0025deg_ip.gpkg.zip',
     help='path to the base layer filling areas not modelled by OpenStreetMap')
+    cmdLineParser.add_argument('--keep-intermediates', action='store_true',
+    help='keep the intermediate GeoPackages of the conversion stages for '
+    'faster reruns with modified inputs')
+    cmdLineParser.add_argument('--force', action='store_true',
+    help='rerun all conversion stages even if their outputs are up to date')
+    cmdLineParser.add_argument('--trim-baselayer', action='store_true',
+    help='subtract OSM areas covering the base layer from its polygons to '
+    'save fill time when rendering')
+    cmdLineParser.add_argument('--trim-cell', type=float, default=0.5,
+    help='grid cell size in degrees for trimming the base layer (default: '
+    '0.5)')
+    cmdLineParser.add_argument('--trim-filter', default=coverAreaFilter,
+    help='SQL condition selecting the OSM multipolygons that cover the base '
+    'layer (default: opaquely painted land use and natural areas)')
+    cmdLineParser.add_argument('--hilbert-order', action='store_true',
+    help='store the features of all layers in Hilbert curve order for '
+    'faster reads of spatially local renders')
+    cmdLineParser.add_argument('--osm-index', choices=['auto', 'ram', 'disk'],
+    default='auto', help='keep the temporary OSM node store in RAM or on '
+    'disk, auto chooses by available memory and input size (default: auto)')
+    cmdLineParser.add_argument('--osm-memory', type=float, help='memory '
+    'budget of the OSM node store in MiB (default: 60%% of available memory)')
+    cmdLineParser.add_argument('--osm-tmpdir', help='directory for the OSM '
+    'node store on disk (default: the one with the most free space)')
+    cmdLineParser.add_argument('--max-jobs', type=int, default=os.cpu_count(),
+    help='maximum number of external tools running at the same time')
+    cmdLineParser.add_argument('--tool-timeout', type=float, help=
+    'maximum runtime of a single external tool in seconds (default: none)')
     cmdLineParser.add_argument('-v', '--version', action='version',
     version='%(prog)s 1.0')
 
@@ -133,9 +165,12 @@ def checkToolchain(args):
     #
     gdalMinVersion='3.9'
 
-    for gdalTool in ['ogr2ogr', 'ogrinfo']:
+    gdalTools=['ogr2ogr', 'ogrinfo']
+    toolResults=runExecutables([{'args': [gdalTool, '--version']} for 
+    gdalTool in gdalTools], args.max_jobs, progress=None)
+
+    for gdalTool, toolResult in zip(gdalTools, toolResults):
 
-        toolResult=runExecutable([gdalTool, '--version'])
         toolVersion=toolResult.output.replace(",", "").split()
 
         if len(toolVersion)>=2 and toolVersion[0]=='GDAL' and \
@@ -152,32 +187,31 @@ def checkToolchain(args):
 ##############################################################################
 
 
-def querySingleExtent(ogrFile, layerName):
+def parseSingleExtent(toolResult, layerName):
     """
-    Computes the extent of the given feature layer of the input vector file,
-    i.e., OSM serializations or GeoPackages, assuming geodetic coordinates.
+    Extracts the extent of the given feature layer of the input vector file,
+    i.e., OSM serializations or GeoPackages, from the summary printed by
+    ogrinfo assuming geodetic coordinates.
 
     Args:
-        args: the parsed command line arguments        
+        toolResult: the result of "ogrinfo -summary" for the layer
+        layerName: the name of the feature layer
 
     Returns:
         The bounding box of the feature layer of the OSM serialization as 
         a floating-point lonMin, latMin, lonMax, latMax list.
     """
 
-    toolResult=runExecutable(['ogrinfo', '-summary',  ogrFile, layerName])
-
     if toolResult.exitCode!=0:
-        print('Extent extraction finished with errors (did you correctly '
-        'set the GDAL_DATA and PROJ_DATA environment variables ?)')
-        sys.exit(2)
+        raise ConversionError('Extent extraction finished with errors (did '
+        'you correctly set the GDAL_DATA and PROJ_DATA environment '
+        'variables ?)', 2)
 
     # search for 'Extent: ...' line in program output
     toolOutputList=re.findall(r"Extent:.*", toolResult.output)
     if len(toolOutputList)!=1:
-        print('Failed to extract extent for layer', layerName, 
-        'from OSM serialization')
-        sys.exit(2)
+        raise ConversionError('Failed to extract extent for layer '+
+        layerName+' from OSM serialization', 2)
 
     # keep floating-point numbers only
     toolOutputList=re.findall(r"[-+]?(?:\d*\.*\d+)", toolOutputList[0])
@@ -185,9 +219,9 @@ def querySingleExtent(ogrFile, layerName):
     toolOutputList=[x for x in toolOutputList if x]
 
     if len(toolOutputList)!=4:
-        print('Found extent for layer', layerName, 'in OSM serialization,'
-        ' but expected four not', len(toolOutputList), 'coordinates')
-        sys.exit(2)
+        raise ConversionError('Found extent for layer '+layerName+' in OSM '
+        'serialization, but expected four not '+str(len(toolOutputList))+
+        ' coordinates', 2)
 
     return [float(toolOutputList[0]), float(toolOutputList[1]), 
     float(toolOutputList[2]), float(toolOutputList[3])]
@@ -196,24 +230,29 @@ def querySingleExtent(ogrFile, layerName):
 ##############################################################################
 
 
-def computeExtent(ogrFile):
+def computeExtent(ogrFile, maxJobs=None):
     """
     Computes the common extent of the multipolygons, lines and points layers 
     of the input vector file, i.e., OSM serializations or GeoPackages, 
     assuming geodetic coordinates.
 
     Args:
-        args: the parsed command line arguments        
+        ogrFile: the path to the vector file
+        maxJobs: the maximum number of concurrent ogrinfo queries
 
     Returns:
         The common bounding box of the above layers of the OSM serialization 
         as a floating-point lonMin, latMin, lonMax, latMax list.
     """
                     
-    # query extents
-    multiPolysExtent=querySingleExtent(ogrFile, 'multipolygons')
-    linesExtent=querySingleExtent(ogrFile, 'lines')
-    pointsExtent=querySingleExtent(ogrFile, 'points')
+    # query extents of the layers concurrently
+    layerNames=['multipolygons', 'lines', 'points']
+    toolResults=runExecutables([{'args': ['ogrinfo', '-summary', ogrFile, 
+    layerName]} for layerName in layerNames], maxJobs, progress=None)
+
+    [multiPolysExtent, linesExtent, pointsExtent]=[parseSingleExtent(
+    toolResult, layerName) for toolResult, layerName in zip(toolResults, 
+    layerNames)]
 
     # compute common bounding box
     lonMin=min(multiPolysExtent[0], linesExtent[0], pointsExtent[0]) 
@@ -227,92 +266,1004 @@ def computeExtent(ogrFile):
 ##############################################################################
 
 
-def convertOsmScene(args):
+def outputBaseName(args):
     """
-    Converts the OSM serialization into a GeoPackage and merges it with the
-    base and water polygon  layers.
+    Returns the output file name without the GeoPackage and zip extensions
+    to derive the names of the intermediate files from.
 
     Args:
-        args: the parsed command line arguments        
+        args: the parsed command line arguments
+
+    Returns:
+        The output base name
     """
 
-    tempOutput=os.path.splitext(args.output)[0]+'_temp.gpkg'
+    outputBase=args.output
+    if outputBase.lower().endswith('.zip'):
+        outputBase=outputBase[:-4]
 
-    #
-    # convert serialization into raw GPKG
-    #
-    print('')
-    print('Creating raw GPKG', tempOutput,'from OSM serialization',
+    return os.path.splitext(outputBase)[0]
+
+
+##############################################################################
+
+
+def partialFileName(fileName):
+    """
+    Returns the name a stage output is written to before it gets atomically
+    renamed to its final name. The GeoPackage extension is kept so GDAL
+    still recognizes the output format including SOZip compression.
+
+    Args:
+        fileName: the final name of the stage output
+
+    Returns:
+        The name of the partial stage output
+    """
+
+    dirName, baseName=os.path.split(fileName)
+
+    extPos=baseName.rfind('.gpkg')
+    if extPos<0:
+        extPos=len(os.path.splitext(baseName)[0])
+
+    return os.path.join(dirName, baseName[:extPos]+'.partial'+
+    baseName[extPos:])
+
+
+##############################################################################
+
+
+def fingerprintFile(fileName, hashContents=False):
+    """
+    Computes the fingerprint of a stage input file. Large inputs like OSM
+    serializations are identified by their path, size and modification time
+    like make does, small configuration files by their contents.
+
+    Args:
+        fileName: the path to the input file
+        hashContents: fingerprint the file contents rather than its
+                      modification time
+
+    Returns:
+        The fingerprint as a dictionary
+    """
+
+    try:
+        fileStat=os.stat(fileName)
+    except OSError:
+        raise ConversionError('Cannot access input file '+fileName)
+
+    fingerprint={'path': os.path.abspath(fileName), 'size': fileStat.st_size}
+
+    if hashContents:
+        with open(fileName, 'rb') as source:
+            fingerprint['sha256']=hashlib.sha256(source.read()).hexdigest()
+    else:
+        fingerprint['mtime']=fileStat.st_mtime_ns
+
+    return fingerprint
+
+
+##############################################################################
+
+
+def loadManifest(manifestFile):
+    """
+    Loads the checkpoint manifest recording the completed conversion stages.
+
+    Args:
+        manifestFile: the path to the JSON manifest
+
+    Returns:
+        The manifest as a dictionary indexed by stage name, empty if there
+        is no (readable) manifest
+    """
+
+    try:
+        with open(manifestFile, 'r') as source:
+            return json.load(source)
+    except (OSError, ValueError):
+        return {}
+
+
+##############################################################################
+
+
+def saveManifest(manifestFile, manifest):
+    """
+    Atomically writes the checkpoint manifest.
+
+    Args:
+        manifestFile: the path to the JSON manifest
+        manifest: the manifest as a dictionary indexed by stage name
+    """
+
+    with open(manifestFile+'.partial', 'w') as target:
+        json.dump(manifest, target, indent=2, sort_keys=True)
+
+    os.replace(manifestFile+'.partial', manifestFile)
+
+
+##############################################################################
+
+
+def availableMemory():
+    """
+    Determines the physical memory available to new processes without
+    swapping.
+
+    Returns:
+        The available memory in bytes, or None if it cannot be determined
+    """
+
+    # Linux: includes reclaimable caches
+    try:
+        with open('/proc/meminfo', 'r') as source:
+            for line in source:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+##############################################################################
+
+
+def planNodeIndex(args):
+    """
+    Sizes the temporary node and way store of the GDAL OSM driver to the
+    machine. If the estimated store fits into the memory budget, it is kept
+    in RAM entirely. Otherwise it spills to compressed temporary files in 
+    the directory with the most free space.
+
+    Args:
+        args: the parsed command line arguments
+
+    Returns:
+        A SimpleNamespace with the members "inRam", "maxTmpFileSize" (MiB),
+        "compressNodes", "tmpDir" (None for the GDAL default), 
+        "estimatedSize" and "memoryBudget" (bytes, None if unknown)
+    """
+
+    inputSize=os.path.getsize(args.osmSerialization)
+    bytesPerInputByte=nodeStorePerPbfByte if args.osmSerialization.lower(
+    ).endswith('.pbf') else nodeStorePerXmlByte
+    estimatedSize=int(inputSize*bytesPerInputByte)
+
+    memoryBudget=None
+    if args.osm_memory:
+        memoryBudget=int(args.osm_memory*(1<<20))
+    elif availableMemory():
+        memoryBudget=int(availableMemory()*nodeStoreMemoryShare)
+
+    indexMode=args.osm_index
+    if indexMode=='auto':
+        indexMode='ram' if memoryBudget and estimatedSize<=memoryBudget else \
+        'disk'
+
+    plan=SimpleNamespace(inRam=indexMode=='ram', maxTmpFileSize=None,
+    compressNodes=indexMode=='disk', tmpDir=args.osm_tmpdir, 
+    estimatedSize=estimatedSize, memoryBudget=memoryBudget)
+
+    if plan.inRam:
+        # headroom since the estimate is rough
+        plan.maxTmpFileSize=max(100, math.ceil(estimatedSize*1.25/(1<<20)))
+
+        if memoryBudget and estimatedSize>memoryBudget:
+            print('Warning: the estimated node store of', estimatedSize>>20,
+            'MiB exceeds the memory budget of', memoryBudget>>20, 'MiB')
+    else:
+        # the in-memory part holds the start of the store before spilling,
+        # it stays at the driver default if forced to disk
+        plan.maxTmpFileSize=100
+        if args.osm_index=='auto':
+            plan.maxTmpFileSize=max(100, min(estimatedSize,
+            memoryBudget or 0)>>20)
+
+        # spill to the candidate directory with the most free space
+        if not plan.tmpDir:
+            candidateDirs=[tempfile.gettempdir(), os.path.dirname(
+            os.path.abspath(args.output))]
+            freeSpaces={candidateDir: shutil.disk_usage(candidateDir).free for
+            candidateDir in candidateDirs if os.path.isdir(candidateDir)}
+
+            if freeSpaces:
+                plan.tmpDir=max(freeSpaces, key=freeSpaces.get)
+
+                if freeSpaces[plan.tmpDir]<estimatedSize:
+                    print('Warning: only', freeSpaces[plan.tmpDir]>>20, 
+                    'MiB free in', plan.tmpDir, 'for an estimated node store'
+                    ' of', estimatedSize>>20, 'MiB')
+
+    return plan
+
+
+##############################################################################
+
+
+def reportNodeIndex(plan, debugLines, inputSize, runtime):
+    """
+    Reports the statistics of the node and way store the GDAL OSM driver 
+    printed as debug messages.
+
+    Args:
+        plan: the node index plan as returned by planNodeIndex()
+        debugLines: the "OSM:" debug output lines of ogr2ogr
+        inputSize: the size of the OSM serialization in bytes
+        runtime: the runtime of the conversion in seconds
+    """
+
+    # counters like "nNodeSelectIn = 42" or "Number of bytes read : 42"
+    statistics={}
+    for line in debugLines:
+        match=re.search(r'OSM:\s*(.+?)\s*[=:]\s*([0-9.]+)\s*$', line)
+        if match:
+            statistics[match.group(1)]=match.group(2)
+
+    spillLines=[line for line in debugLines if re.search(
+    r'\b(disk|transfer|switch)', line, re.IGNORECASE)]
+
+    print('Node store statistics: planned', 'in RAM' if plan.inRam else 
+    'on disk', 'with', plan.maxTmpFileSize, 'MiB in-memory limit,', 
+    'spilled to disk' if spillLines else 'no spill to disk reported', 
+    'by the OSM driver,', f'{inputSize/(1<<20)/max(runtime, 1e-3):.1f}', 
+    'MiB/s input throughput')
+
+    for name, value in statistics.items():
+        print('   ', name+':', value)
+
+    for line in spillLines:
+        print('   ', line.strip())
+
+
+##############################################################################
+
+
+def convertRawStage(args, stage, partialOutput, stages, manifest):
+    """
+    Conversion stage turning the OSM serialization into a raw GeoPackage.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        partialOutput: the file the stage output must be written to
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+
+    Returns:
+        The stage metadata containing the extent of the raw GeoPackage
+    """
+
+    print('Creating raw GPKG', stage.output,'from OSM serialization',
     args.osmSerialization)
 
-    # insert verbatim OGR options at the right place, if any
-    toolCmdline=['ogr2ogr', '-f', 'GPKG', '--config', 
-    'OSM_CONFIG_FILE='+args.osmconf, tempOutput, args.osmSerialization]
+    plan=planNodeIndex(args)
+    print('Node store of about', plan.estimatedSize>>20, 'MiB kept', 
+    'in RAM' if plan.inRam else 'on disk in '+(plan.tmpDir or 
+    'the default temporary directory'), '(memory budget:', 
+    str(plan.memoryBudget>>20)+' MiB)' if plan.memoryBudget else 'unknown)')
+
+    # debug messages of the OSM driver only, they carry the statistics
+    toolCmdline=['ogr2ogr', '-f', 'GPKG', '--config',
+    'OSM_CONFIG_FILE='+args.osmconf, '--config', 'OSM_USE_CUSTOM_INDEXING=YES',
+    '--config', 'OSM_MAX_TMPFILE_SIZE='+str(plan.maxTmpFileSize), '--config',
+    'OSM_COMPRESS_NODES='+('YES' if plan.compressNodes else 'NO'), '--config',
+    'CPL_DEBUG=OSM', partialOutput, args.osmSerialization]
 
+    if plan.tmpDir:
+        toolCmdline[-2:-2]=['--config', 'CPL_TMPDIR='+plan.tmpDir]
+
+    # insert verbatim OGR options at the right place, if any
     if args.ogropts:
-        toolCmdline.insert(5, args.ogropts)
+        toolCmdline[-2:-2]=args.ogropts
+
+    debugLines=[]
+
+    def collectDebugLine(line):
+        if 'OSM:' in line:
+            debugLines.append(line)
+
+    toolResult=runExecutable(toolCmdline, printCmdLine=True,
+    streamOutput=True, timeout=args.tool_timeout,
+    outputPrefix=stage.outputPrefix, lineCallback=collectDebugLine)
 
-    toolResult=runExecutable(toolCmdline, printCmdLine=True)
-    print(toolResult.output)
+    reportNodeIndex(plan, debugLines, os.path.getsize(args.osmSerialization),
+    toolResult.runtime)
 
     if toolResult.exitCode!=0:
-        print('Conversion of OSM serialization into raw GPKG', 
-        tempOutput, 'failed')
-        sys.exit(3)
+        raise ConversionError('Conversion of OSM serialization into raw '
+        'GPKG '+stage.output+' failed')
 
     #
-    # compute extent from GPKG incorporating any initial OSM scene 
+    # compute extent from GPKG incorporating any initial OSM scene
     # crop/selection
     #
     print('Computing extents of raw GPKG serialization', args.osmSerialization)
-    [lonMin, latMin, lonMax, latMax]=computeExtent(tempOutput)
-    print('... which is', [lonMin, latMin, lonMax, latMax])
+    extent=computeExtent(partialOutput, args.max_jobs)
+    print('... which is', extent)
 
-    #
-    # integrate base layer
-    #
-    print('Integrating base layer', args.baselayer, 'into', tempOutput)
-    toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG', '-update', '-nlt',
-    'PROMOTE_TO_MULTI', '-nln', 'multipolygons_baselayer', '-wrapdateline',
-    '-clipsrc', str(lonMin), str(latMin), str(lonMax), str(latMax), 
-    tempOutput, args.baselayer, 'multipolygons'], printCmdLine=True)
-    print(toolResult.output)
+    return {'extent': extent}
+
+
+##############################################################################
+
+
+def integrateLayerStage(args, stage, partialOutput, stages, manifest):
+    """
+    Conversion stage clipping a global polygon layer, i.e., the base layer
+    or the water polygons, to the extent of the raw GeoPackage.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        partialOutput: the file the stage output must be written to
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+    """
+
+    layerFile=stage.inputs[0][0]
+    [lonMin, latMin, lonMax, latMax]=manifest['raw']['metadata']['extent']
+
+    print('Integrating', stage.title, layerFile, 'into', stage.output)
+    toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG', '-nlt',
+    'PROMOTE_TO_MULTI', '-nln', stage.params['layerName'], '-wrapdateline',
+    '-clipsrc', str(lonMin), str(latMin), str(lonMax), str(latMax),
+    partialOutput, layerFile, 'multipolygons'], printCmdLine=True,
+    streamOutput=True, timeout=args.tool_timeout,
+    outputPrefix=stage.outputPrefix)
+
+    if toolResult.exitCode!=0:
+        raise ConversionError('Integration of '+stage.title+' '+layerFile+
+        ' into '+stage.output+' failed')
+
+
+##############################################################################
+
+
+def parseGpkgJson(toolResult, gpkgFile):
+    """
+    Extracts the JSON document printed by ogrinfo for a GeoPackage.
+
+    Args:
+        toolResult: the result of the ogrinfo run
+        gpkgFile: the path to the GeoPackage, for error messages
+
+    Returns:
+        The deserialized JSON document printed by ogrinfo
+    """
+
+    # warnings may precede the document since stdout and stderr are merged
+    output=toolResult.output
+    try:
+        if toolResult.exitCode!=0:
+            raise ValueError(output)
+        return json.loads(output[output.find('{'):output.rfind('}')+1])
+    except ValueError:
+        raise ConversionError('Querying '+gpkgFile+' failed: '+
+        output[-1000:]) from None
+
+
+##############################################################################
+
+
+def queryGpkgJson(toolArgs, gpkgFile):
+    """
+    Runs ogrinfo read-only with JSON output on a GeoPackage.
+
+    Args:
+        toolArgs: the ogrinfo arguments as a string list, with the 
+                  GeoPackage to be queried
+        gpkgFile: the path to the GeoPackage, for error messages
+
+    Returns:
+        The deserialized JSON document printed by ogrinfo
+    """
+
+    return parseGpkgJson(runExecutable(['ogrinfo', '-ro', '-json']+
+    toolArgs), gpkgFile)
+
+
+##############################################################################
+
+
+def readLayerColumns(gpkgFile, layerName):
+    """
+    Determines the attribute and geometry columns of a GeoPackage layer.
+
+    Args:
+        gpkgFile: the path to the GeoPackage
+        layerName: the name of the layer
+
+    Returns:
+        The list of attribute column names without the FID, and the name of
+        the geometry column
+    """
+
+    layerInfo=queryGpkgJson(['-so', gpkgFile, layerName], gpkgFile)
+
+    try:
+        layerInfo=layerInfo['layers'][0]
+        return [field['name'] for field in layerInfo.get('fields', [])], \
+        layerInfo['geometryFields'][0]['name']
+    except (KeyError, IndexError, TypeError):
+        raise ConversionError('Cannot determine the columns of '+layerName+
+        ' in '+gpkgFile) from None
+
+
+##############################################################################
+
+
+def trimBaselayerStage(args, stage, partialOutput, stages, manifest):
+    """
+    Optional conversion stage subtracting the OSM areas covering the base
+    layer from its polygons, so the renderer does not fill base layer 
+    pixels that get painted over anyway. The base layer is processed 
+    concurrently in the cells of a regular grid to bound the memory of the
+    geometry operations: base polygons and covering areas are clipped to 
+    the cell before the difference is computed, so base polygons spanning
+    several cells are split along the cell boundaries.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        partialOutput: the file the stage output must be written to
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+    """
+
+    rawOutput=stages['raw'].output
+    layerStage=stages['baselayer']
+    layerName=layerStage.params['layerName']
+    partialBase=partialOutput[:-len('.gpkg')]
+
+    # the covering areas and the base layer must share a GeoPackage
+    workFile=partialBase+'_work.gpkg'
+    shutil.copyfile(layerStage.output, workFile)
+    cellFiles=[]
+
+    try:
+        print('Collecting OSM areas covering the base layer from', rawOutput)
+        toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG', '-update', 
+        '-nln', 'trim_cover', '-nlt', 'PROMOTE_TO_MULTI', '-lco', 
+        'GEOMETRY_NAME=geom', '-select', 
+        'osm_id', '-where', stage.params['coverFilter'], workFile, rawOutput,
+        'multipolygons'], printCmdLine=True, streamOutput=True, 
+        timeout=args.tool_timeout, outputPrefix=stage.outputPrefix)
+
+        if toolResult.exitCode!=0:
+            raise ConversionError('Collecting covering OSM areas from '+
+            rawOutput+' failed')
+
+        [fieldNames, geometryName]=readLayerColumns(workFile, layerName)
+
+        coverColumn='geom'
+        baseColumns=', '.join('"'+fieldName+'"' for fieldName in fieldNames)
+
+        #
+        # each cell trims the parts of the base polygons inside it, the outer
+        # cells extend to the limits of the geodetic coordinates
+        #
+        [lonMin, latMin, lonMax, latMax]=manifest['raw']['metadata']['extent']
+        cellSize=stage.params['cellSize']
+        lonBounds=[lonMin+i*cellSize for i in range(1, math.ceil((lonMax-
+        lonMin)/cellSize))]
+        latBounds=[latMin+j*cellSize for j in range(1, math.ceil((latMax-
+        latMin)/cellSize))]
+        lonBounds=[-180.0]+lonBounds+[180.0]
+        latBounds=[-90.0]+latBounds+[90.0]
+
+        jobs=[]
+        for i in range(len(lonBounds)-1):
+            for j in range(len(latBounds)-1):
+                cellFiles.append(partialBase+f'_cell_{i}_{j}.gpkg')
+                [x0, x1, y0, y1]=[lonBounds[i], lonBounds[i+1], latBounds[j],
+                latBounds[j+1]]
+                cellBox=f'BuildMbr({x0!r}, {y0!r}, {x1!r}, {y1!r}, ST_SRID('
+
+                #
+                # SpatiaLite functions accept GeoPackage geometries; the
+                # R-trees restrict both layers to the cell, and only the
+                # parts of the covering areas inside it are united. The 
+                # functions return NULL for empty results as well as on 
+                # GEOS errors, e.g., for invalid geometries, so failures 
+                # are told apart by predicates, and the affected polygons
+                # are kept unclipped (trim_fallback 1) or untrimmed (2)
+                #
+                clipSql=(f'SELECT b.*, ST_Intersection(b."{geometryName}", '
+                f'{cellBox}b."{geometryName}"))) AS clip_raw, COALESCE('
+                f'ST_Intersects(b."{geometryName}", {cellBox}b.'
+                f'"{geometryName}"))), -1)<>0 AS clip_hit FROM "{layerName}" '
+                f'AS b JOIN "rtree_{layerName}_{geometryName}" AS rb ON '
+                f'b.fid=rb.id WHERE rb.maxx>={x0!r} AND rb.minx<={x1!r} AND '
+                f'rb.maxy>={y0!r} AND rb.miny<={y1!r}')
+
+                clippedSql=('SELECT b.*, clip_raw IS NULL AND clip_hit AS '
+                f'clip_failed, COALESCE(clip_raw, CASE WHEN clip_hit THEN b.'
+                f'"{geometryName}" END) AS clipped FROM ({clipSql}) AS b')
+
+                coverSql=(f'SELECT b.*, (SELECT ST_Union(ST_Intersection(c.'
+                f'"{coverColumn}", {cellBox}c."{coverColumn}")))) FROM '
+                f'trim_cover AS c JOIN rtree_trim_cover_{coverColumn} AS rc '
+                f'ON c.fid=rc.id WHERE rc.maxx>=ST_MinX(b.clipped) AND '
+                f'rc.minx<=ST_MaxX(b.clipped) AND rc.maxy>=ST_MinY(b.clipped)'
+                f' AND rc.miny<=ST_MaxY(b.clipped) AND ST_Intersects(c.'
+                f'"{coverColumn}", b.clipped)) AS cover FROM ({clippedSql}) '
+                f'AS b WHERE clipped IS NOT NULL AND NOT ST_IsEmpty(clipped)')
+
+                differenceSql=('SELECT b.*, CASE WHEN b.cover IS NOT NULL '
+                'THEN ST_Difference(b.clipped, b.cover) END AS difference '
+                f'FROM ({coverSql}) AS b')
+
+                # an empty difference is fine if the cover covers it all
+                trimmedSql=('SELECT b.*, b.cover IS NOT NULL AND b.difference'
+                ' IS NULL AND COALESCE(ST_Covers(b.cover, b.clipped), -1)<>1 '
+                f'AS difference_failed FROM ({differenceSql}) AS b')
+
+                cellSql=(f'SELECT {baseColumns}{", " if baseColumns else ""}'
+                'trimmed AS geom, trim_fallback FROM (SELECT b.*, '
+                'CollectionExtract(CASE WHEN b.cover IS NULL OR '
+                'b.difference_failed THEN b.clipped ELSE b.difference END, 3)'
+                ' AS trimmed, CASE WHEN b.clip_failed THEN 1 WHEN '
+                'b.difference_failed THEN 2 ELSE 0 END AS trim_fallback FROM '
+                f'({trimmedSql}) AS b) WHERE trimmed IS NOT NULL AND NOT '
+                'ST_IsEmpty(trimmed)')
+
+                jobs.append({'name': f'cell {i},{j}', 'args': ['ogr2ogr', '-f',
+                'GPKG', '-nln', layerName, '-nlt', 'MULTIPOLYGON', '-dialect',
+                'SQLite', '-sql', cellSql, cellFiles[-1], workFile], 
+                'timeout': args.tool_timeout, 'tempFiles': [cellFiles[-1]]})
+
+        print('Trimming', layerName, 'in', len(jobs), 'grid cells of', 
+        cellSize, 'degrees')
+        toolResults=runExecutables(jobs, args.max_jobs, failFast=True)
+
+        failedResults=[toolResult for toolResult in toolResults if 
+        toolResult.exitCode!=0]
+        if failedResults:
+            # report the failed cell rather than the ones cancelled due to it
+            print(next((toolResult for toolResult in failedResults if 
+            toolResult.exitCode is not None or toolResult.timedOut), 
+            failedResults[0]).output[-2000:])
+            raise ConversionError('Trimming '+layerName+' failed (is GDAL '
+            'built with SpatiaLite support?)')
+
+        # polygons kept unclipped or untrimmed due to geometry errors
+        toolResults=runExecutables([{'args': ['ogrinfo', '-ro', '-json', 
+        '-features', '-sql', 'SELECT trim_fallback, COUNT(*) AS n FROM '
+        f'"{layerName}" WHERE trim_fallback>0 GROUP BY trim_fallback', 
+        cellFile]} for cellFile in cellFiles], args.max_jobs, progress=None)
+
+        fallbackCounts={1: 0, 2: 0}
+        for cellFile, toolResult in zip(cellFiles, toolResults):
+            for layer in parseGpkgJson(toolResult, cellFile).get('layers', []):
+                for feature in layer.get('features', []):
+                    counts=feature['properties']
+                    fallbackCounts[int(counts['trim_fallback'])]+=counts['n']
+
+        if fallbackCounts[1] or fallbackCounts[2]:
+            print('Geometry errors: kept', fallbackCounts[1], 'polygon parts '
+            'of', layerName, 'unclipped and', fallbackCounts[2], 'untrimmed')
+
+        # cells are written one after another into the stage output, 
+        # without the fallback flags
+        for cellIndex, cellFile in enumerate(cellFiles):
+            toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG']+(['-update', 
+            '-append'] if cellIndex>0 else [])+['-nln', layerName, '-nlt', 
+            'MULTIPOLYGON', '-sql', f'SELECT {baseColumns}'
+            f'{", " if baseColumns else ""}geom FROM "{layerName}"', 
+            partialOutput, cellFile], timeout=args.tool_timeout)
+
+            if toolResult.exitCode!=0:
+                print(toolResult.output[-2000:])
+                raise ConversionError('Merging trimmed cell '+cellFile+
+                ' into '+stage.output+' failed')
+    finally:
+        removeFiles([workFile]+cellFiles)
+
+
+##############################################################################
+
+
+def mergeStage(args, stage, partialOutput, stages, manifest):
+    """
+    Conversion stage merging the raw GeoPackage with the clipped base and
+    water polygon layers.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        partialOutput: the file the stage output must be written to
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+    """
+
+    rawOutput=stages['raw'].output
+    print('Merging', rawOutput, 'and clipped layers into', stage.output)
+
+    # the raw GPKG must be kept intact for reruns, so work on a copy
+    shutil.copyfile(rawOutput, partialOutput)
+
+    # the base layer may come trimmed
+    for layerStage in [stages[dep] for dep in stage.deps[1:]]:
+
+        toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG', '-update',
+        partialOutput, layerStage.output, layerStage.params['layerName']],
+        printCmdLine=True, streamOutput=True, timeout=args.tool_timeout,
+        outputPrefix=stage.outputPrefix)
+
+        if toolResult.exitCode!=0:
+            raise ConversionError('Merging '+layerStage.output+' into '+
+            stage.output+' failed')
+
+
+##############################################################################
+
+
+def hilbertOrderStage(args, stage, partialOutput, stages, manifest):
+    """
+    Optional conversion stage rewriting all layers in the order of a Hilbert
+    curve through the centers of the feature bounding boxes. The features
+    get new FIDs in curve order, and since GeoPackage tables are stored in 
+    FID order, spatially close features end up in neighbouring pages and 
+    bounding box queries read mostly contiguous parts of the file.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        partialOutput: the file the stage output must be written to
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+    """
+
+    sourceOutput=stages[stage.deps[-1]].output
+    [lonMin, latMin, lonMax, latMax]=manifest['raw']['metadata']['extent']
+
+    # curve resolution per axis, as a power of two
+    curveSize=1<<stage.params['curveOrder']
+    scaleX=(curveSize-1)/max(lonMax-lonMin, 1e-9)
+    scaleY=(curveSize-1)/max(latMax-latMin, 1e-9)
+
+    geometryColumns=queryGpkgJson(['-features', '-sql', 'SELECT table_name, '
+    'geometry_type_name FROM gpkg_geometry_columns', sourceOutput], 
+    sourceOutput)
+    layerTypes={feature['properties']['table_name']: feature['properties'][
+    'geometry_type_name'] for layer in geometryColumns.get('layers', []) for
+    feature in layer.get('features', [])}
+
+    print('Rewriting', len(layerTypes), 'layers of', sourceOutput, 
+    'in Hilbert curve order into', stage.output)
+
+    for layerIndex, (layerName, geometryType) in enumerate(sorted(
+    layerTypes.items())):
+
+        [fieldNames, geometryName]=readLayerColumns(sourceOutput, layerName)
+
+        #
+        # Hilbert index of the bounding box centers by the iterative 
+        # algorithm, one recursion step per curve level; features without
+        # a bounding box come first
+        #
+        rx='((p.x&p.s)>0)'
+        ry='((p.y&p.s)>0)'
+
+        hilbertSql=(f'WITH RECURSIVE p(id, x, y, s, d) AS (SELECT id, '
+        f'MIN(MAX(CAST(((minx+maxx)/2-{lonMin!r})*{scaleX!r} AS INTEGER), 0),'
+        f' {curveSize-1}), MIN(MAX(CAST(((miny+maxy)/2-{latMin!r})*'
+        f'{scaleY!r} AS INTEGER), 0), {curveSize-1}), {curveSize//2}, 0 '
+        f'FROM "rtree_{layerName}_{geometryName}" UNION ALL SELECT id, CASE '
+        f'WHEN {ry}=0 THEN CASE WHEN {rx}=1 THEN {curveSize-1}-p.y ELSE p.y '
+        f'END ELSE p.x END, CASE WHEN {ry}=0 THEN CASE WHEN {rx}=1 THEN '
+        f'{curveSize-1}-p.x ELSE p.x END ELSE p.y END, p.s/2, p.d+p.s*p.s*'
+        f'(((3*{rx})|{ry})-((3*{rx})&{ry})) FROM p WHERE p.s>0) SELECT id, d '
+        f'FROM p WHERE s=0')
+
+        # the old FIDs are left out, so new ones are assigned in curve order
+        layerSql=('SELECT '+''.join('l."'+fieldName+'", ' for fieldName in 
+        fieldNames)+f'l."{geometryName}" FROM "{layerName}" AS l LEFT JOIN ('
+        f'{hilbertSql}) AS h ON l.fid=h.id ORDER BY h.d')
+
+        toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG']+(['-update'] if 
+        layerIndex>0 else [])+['-nln', layerName, '-nlt', geometryType, 
+        '-lco', 'GEOMETRY_NAME='+geometryName, '-sql', layerSql, 
+        partialOutput, sourceOutput], printCmdLine=True, streamOutput=True,
+        timeout=args.tool_timeout, outputPrefix=stage.outputPrefix)
+
+        if toolResult.exitCode!=0:
+            raise ConversionError('Rewriting layer '+layerName+' of '+
+            sourceOutput+' in Hilbert curve order failed')
+
+        print('Rewrote layer', layerName)
+
+
+##############################################################################
+
+
+def finalizeStage(args, stage, partialOutput, stages, manifest):
+    """
+    Conversion stage writing the final (possibly compressed) output.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        partialOutput: the file the stage output must be written to
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+    """
+
+    sourceOutput=stages[stage.deps[0]].output
+
+    print('Finalizing output', args.output)
+    toolResult=runExecutable(['ogr2ogr', partialOutput, sourceOutput],
+    printCmdLine=True, streamOutput=True, timeout=args.tool_timeout,
+    outputPrefix=stage.outputPrefix)
 
     if toolResult.exitCode!=0:
-        print('Integration of base layer', args.baselayer, 'into', 
-        tempOutput, 'failed')
-        sys.exit(3)
+        raise ConversionError('Finalization of output '+args.output+
+        ' from '+sourceOutput+' failed')
+
+
+##############################################################################
+
+
+def defineStages(args):
+    """
+    Defines the conversion stages, their inputs and outputs.
+
+    Args:
+        args: the parsed command line arguments
+
+    Returns:
+        The list of stage descriptions in the order of execution, i.e.,
+        each stage comes after the stages it depends on
+    """
+
+    outputBase=outputBaseName(args)
+
+    def stage(name, title, output, run, deps=[], inputs=[], params={}):
+        return SimpleNamespace(name=name, title=title, output=output,
+        run=run, deps=deps, inputs=inputs, params=params, outputPrefix='')
+
+    stageList=[
+        # the OSM configuration is small, but often edited in place
+        stage('raw', 'raw GPKG', outputBase+'_raw.gpkg', convertRawStage,
+        inputs=[(args.osmSerialization, False), (args.osmconf, True)],
+        params={'ogropts': args.ogropts or []}),
+
+        stage('baselayer', 'base layer', outputBase+'_baselayer.gpkg',
+        integrateLayerStage, deps=['raw'], inputs=[(args.baselayer, False)],
+        params={'layerName': 'multipolygons_baselayer'}),
+
+        stage('water', 'water polygons', outputBase+'_water.gpkg',
+        integrateLayerStage, deps=['raw'], inputs=[(args.waterlayer, False)],
+        params={'layerName': 'multipolygons_water'})
+    ]
+
+    baseStage='baselayer'
+    if args.trim_baselayer:
+        baseStage='trim'
+        stageList.append(stage('trim', 'trimmed base layer', outputBase+
+        '_trimmed.gpkg', trimBaselayerStage, deps=['raw', 'baselayer'],
+        params={'layerName': 'multipolygons_baselayer', 'coverFilter':
+        args.trim_filter, 'cellSize': args.trim_cell}))
+
+    stageList.append(stage('merge', 'merged GPKG', outputBase+'_temp.gpkg',
+    mergeStage, deps=['raw', baseStage, 'water']))
+
+    finalSource='merge'
+    if args.hilbert_order:
+        finalSource='hilbert'
+        stageList.append(stage('hilbert', 'Hilbert-ordered GPKG', outputBase+
+        '_hilbert.gpkg', hilbertOrderStage, deps=['raw', 'merge'],
+        params={'curveOrder': 16}))
+
+    return stageList+[
+        stage('final', 'output', args.output, finalizeStage,
+        deps=[finalSource])
+    ]
+
+
+##############################################################################
+
+
+def computeStageKeys(stages):
+    """
+    Computes the keys identifying the outputs of the conversion stages. The
+    key of a stage covers the fingerprints of its input files, its
+    parameters and the keys of the stages it depends on, so changes
+    propagate downstream like in make.
+
+    Args:
+        stages: the list of stage descriptions in the order of execution
+
+    Returns:
+        The stage keys as a dictionary indexed by stage name
+    """
+
+    stageKeys={}
+
+    for stage in stages:
+        keyData={'name': stage.name, 'params': stage.params,
+        'inputs': [fingerprintFile(fileName, hashContents) for fileName,
+        hashContents in stage.inputs],
+        'deps': [stageKeys[dep] for dep in stage.deps]}
+
+        stageKeys[stage.name]=hashlib.sha256(json.dumps(keyData,
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+    return stageKeys
+
+
+##############################################################################
+
+
+def isStageUpToDate(stage, stageKey, manifest):
+    """
+    Checks if the output of a conversion stage is complete and has been
+    produced from the current inputs.
+
+    Args:
+        stage: the stage description
+        stageKey: the current key of the stage
+        manifest: the checkpoint manifest
+
+    Returns:
+        True if the stage does not need to be rerun
+    """
+
+    entry=manifest.get(stage.name)
+    if not entry or entry['key']!=stageKey:
+        return False
+
+    # the output must not have been touched since it was recorded
+    try:
+        outputStat=os.stat(stage.output)
+    except OSError:
+        return False
+
+    return outputStat.st_size==entry['size'] and \
+    outputStat.st_mtime_ns==entry['mtime']
+
+
+##############################################################################
+
+
+def runStage(args, stage, stages, manifest):
+    """
+    Runs a conversion stage writing to a partial output that is renamed to
+    the final stage output on success, so an interrupted stage never leaves
+    an output behind that looks valid.
+
+    Args:
+        args: the parsed command line arguments
+        stage: the stage description
+        stages: all stage descriptions indexed by name
+        manifest: the checkpoint manifest
+
+    Returns:
+        The stage metadata returned by the stage function
+    """
+
+    partialOutput=partialFileName(stage.output)
+
+    # leftovers of a crashed run
+    removeFiles([partialOutput])
+
+    try:
+        metadata=stage.run(args, stage, partialOutput, stages, manifest)
+        os.replace(partialOutput, stage.output)
+    except BaseException:
+        removeFiles([partialOutput])
+        raise
+
+    return metadata or {}
+
+
+##############################################################################
+
+
+def convertOsmScene(args):
+    """
+    Converts the OSM serialization into a GeoPackage and merges it with the
+    base and water polygon layers. The conversion is split into stages
+    whose completion is recorded in a manifest next to the output, so a
+    rerun resumes from the first stage that is out of date or failed.
+
+    Args:
+        args: the parsed command line arguments
+    """
+
+    stageList=defineStages(args)
+    stages={stage.name: stage for stage in stageList}
+    stageKeys=computeStageKeys(stageList)
+
+    manifestFile=outputBaseName(args)+'_stages.json'
+    manifest=loadManifest(manifestFile)
 
     #
-    # integrate water polygons
+    # determine the stages to be run like make, starting from the output
     #
-    print('Integrating water polygons', args.waterlayer, 'into', tempOutput)
-    toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG', '-update', '-nlt',
-    'PROMOTE_TO_MULTI', '-nln', 'multipolygons_water', '-wrapdateline',
-    '-clipsrc', str(lonMin), str(latMin), str(lonMax), str(latMax), 
-    tempOutput, args.waterlayer, 'multipolygons'], printCmdLine=True)
-    print(toolResult.output)
+    pendingStages=[]
+    visitedStages=set()
 
-    if toolResult.exitCode!=0:
-        print('Integration of water layer', args.waterlayer, 'into', 
-        tempOutput, 'failed')
-        sys.exit(3)
+    # shared dependencies are planned and reported only once
+    def visitStage(name):
+        if name in visitedStages:
+            return
+        visitedStages.add(name)
+
+        if not args.force and isStageUpToDate(stages[name], stageKeys[name],
+        manifest):
+            print('Stage', name, 'is up to date:', stages[name].output)
+            return
+
+        for dep in stages[name].deps:
+            visitStage(dep)
+
+        pendingStages.append(name)
+
+    print('')
+    visitStage(stageList[-1].name)
+
+    if not pendingStages:
+        print('Output', args.output, 'is up to date, nothing to do')
+        return
+
+    print('Stages to be run:', ', '.join(pendingStages))
 
     #
-    # convert to final result
+    # run the stages in waves of independent stages
     #
-    print('Finalizing output', args.output)
-    toolResult=runExecutable(['ogr2ogr', args.output, tempOutput], 
-    printCmdLine=True)
-    print(toolResult.output)
+    while pendingStages:
+
+        wave=[name for name in pendingStages if not [dep for dep in
+        stages[name].deps if dep in pendingStages]]
+
+        for name in wave:
+            manifest.pop(name, None)
+            stages[name].outputPrefix='['+name+'] ' if len(wave)>1 else ''
+        saveManifest(manifestFile, manifest)
+
+        print('')
+        with ThreadPoolExecutor(max_workers=max(1, min(len(wave),
+        args.max_jobs or 1))) as executor:
+            futures={name: executor.submit(runStage, args, stages[name],
+            stages, manifest) for name in wave}
+
+        # record completed stages even if a concurrent stage failed
+        firstError=None
+        for name in wave:
+            try:
+                metadata=futures[name].result()
+            except BaseException as exc:
+                firstError=firstError or exc
+                continue
+
+            outputStat=os.stat(stages[name].output)
+            manifest[name]={'key': stageKeys[name], 'size':
+            outputStat.st_size, 'mtime': outputStat.st_mtime_ns,
+            'metadata': metadata}
+            pendingStages.remove(name)
+
+        saveManifest(manifestFile, manifest)
+
+        if firstError:
+            raise firstError
 
-    if toolResult.exitCode!=0:
-        print('Finalization of output', args.output, 'from', tempOutput, 
-        'failed')
-        sys.exit(3)
+    #
+    # clean up intermediate outputs
+    #
+    if not args.keep_intermediates:
+        for stage in stageList[:-1]:
+            removeFiles([stage.output])
+            manifest.pop(stage.name, None)
 
-    # clean up temporary output
-    os.remove(tempOutput)
+        saveManifest(manifestFile, manifest)
 
 
 ##############################################################################
@@ -330,7 +1281,11 @@ def main(args):
     checkToolchain(args)
 
     # convert
-    convertOsmScene(args)
+    try:
+        convertOsmScene(args)
+    except ConversionError as exc:
+        print(exc)
+        sys.exit(exc.exitCode)
 
 
 ##############################################################################
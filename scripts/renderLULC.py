@@ -23,63 +23,81 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import subprocess
 import os
 import sys
 import argparse
 import re
-from types import SimpleNamespace
+import json
+import socket
+import threading
+import hashlib
+import shutil
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape as xmlEscape
+from concurrent.futures import ThreadPoolExecutor
 import math
 import time
 
 # needs 'pip install packaging'
 from packaging.version import parse as parse_version
 
+# shared with the other scripts in this directory
+from toolRunner import runExecutable, runExecutables, removeFiles
 
-##############################################################################
 
+#
+# rough render cost model of mapnik-render and gdal_translate used to 
+# balance tiles and for dry runs. The render time of a tile is predicted as
+# costPerTile seconds for starting the tools and loading the style sheet,
+# plus costPerPixel seconds per rendered pixel including the margin, plus
+# costPerFeature seconds per feature and costPerVertex seconds per vertex
+# intersecting the tile. Only the ratios matter for balancing; to 
+# recalibrate the absolute figures for other hardware or style sheets, 
+# compare the total predicted by --dry-run with the render times printed
+# for the tiles of a real render of a representative scene and scale the 
+# values accordingly, or fit them to tiles of differing feature density
+#
+costPerTile=2.0
+costPerPixel=5e-8
+costPerFeature=2e-5
+costPerVertex=5e-7
 
-def runExecutable(args, stdinStr='', printCmdLine=False):
-    """
-    Runs program with parameters and returns the exit code and output as
-    a dictionary.
+# rough render memory model, in bytes per tile for the tools themselves
+# and bytes per rendered pixel for the RGBA image, the georeferenced 
+# output and buffers
+memoryPerTile=300*(1<<20)
+memoryPerPixel=12
 
-    Args:
-        args: the program name and arguments as a string list
-        stdinStr: the string to be used as stdin input (you may have to add
-                  a newline to terminate)
+# the Python API checks the toolchain once per mapnik-render and plugin 
+# directory, mapping them to the plugin directory to be used
+checkedToolchains={}
 
-    Returns:
-        A SimpleNamespace with the members "exitCode" and "output" for
-        the exit code and merged stdout/err output text respectively encoded
-        using the OS device codepage
-    """
 
-    # we need this to get the console output formatted correctly
-    deviceEncoding=os.device_encoding(1)
+##############################################################################
+
 
-    if printCmdLine:
-        if stdinStr:
-            print('echo', stdinStr, '|', ' '.join(args))
-        else:
-            print(' '.join(args))
+class RenderError(Exception):
+    """
+    Raised when rendering fails. Carries the exit code of the script next 
+    to the message.
+    """
 
-    try:
-        output=subprocess.check_output(args, stderr=subprocess.STDOUT, 
-        input=stdinStr, shell=False, encoding=deviceEncoding)
-    except subprocess.CalledProcessError as exc:
-        return SimpleNamespace(exitCode=exc.returncode, output=exc.output)
-    else:
-        return SimpleNamespace(exitCode=0, output=output)
+    def __init__(self, message, exitCode=4):
+        super().__init__(message)
+        self.exitCode=exitCode
 
 
 ##############################################################################
 
 
-def parseCmdLine():
+def parseCmdLine(argv=None):
     """
     Parses the command line arguments.
 
+    Args:
+        argv: the arguments to be parsed, defaults to those of the script
+
     Returns:
         The parsed arguments which can be accessed as member variables.
     """
@@ -105,8 +123,10 @@ def parseCmdLine():
     help='target ground sampling distance (GSD) of output')
 
     # input/output files
-    cmdLineParser.add_argument('gpkgFile',
-    help='input GeoPackage file (may be zipped with a single GPKG in the archive)')
+    cmdLineParser.add_argument('gpkgFiles', nargs='+', metavar='gpkgFile',
+    help='input GeoPackage file (may be zipped with a single GPKG in the '
+    'archive), several GeoPackages or directories of GeoPackages to render '
+    'across regional extracts')
     cmdLineParser.add_argument('outImage', 
     help='name of output image, file type is derived from extension')
 
@@ -121,8 +141,51 @@ def parseCmdLine():
     'lulc_corine.xml', help='path to the Mapnik style sheet to be used')
     cmdLineParser.add_argument('--no-templates', action='store_true', 
     help='disable default XML template processing (for custom style sheets)')
-
-    return cmdLineParser.parse_args()    
+    cmdLineParser.add_argument('--cache-dir', help='local directory to '
+    'cache uncompressed copies of the input GeoPackage in for faster reads')
+    cmdLineParser.add_argument('--cache-size', type=float, default=50, 
+    help='maximum size of the GeoPackage cache in GiB (default: 50)')
+    cmdLineParser.add_argument('--role', choices=['coordinator', 'worker', 
+    'assemble'], help='distributed rendering: queue tiles, render queued '
+    'tiles, or assemble rendered tiles into the output image')
+    cmdLineParser.add_argument('--queue-dir', help='tile queue directory on '
+    'a filesystem shared by coordinator and workers')
+    cmdLineParser.add_argument('--tile-size', type=int, default=8192,
+    help='maximum width and height of queued tiles in pixels')
+    cmdLineParser.add_argument('--tile-margin', type=int, default=64,
+    help='pixels rendered beyond the tile boundaries to avoid seams')
+    cmdLineParser.add_argument('--lease-time', type=float, default=600,
+    help='seconds after which a tile claimed by a silent worker is retried')
+    cmdLineParser.add_argument('--max-attempts', type=int, default=3,
+    help='maximum number of render attempts per tile')
+    cmdLineParser.add_argument('--poll-interval', type=float, default=10,
+    help='seconds between queue polls of idle workers')
+    cmdLineParser.add_argument('--adaptive', action='store_true', help=
+    'render tiles without OSM features at a coarse resolution and upsample '
+    'them, according to the feature density of the input GeoPackages')
+    cmdLineParser.add_argument('--adaptive-cell', type=int, default=1024,
+    help='smallest adaptive or balanced tile size in pixels (default: 1024)')
+    cmdLineParser.add_argument('--coarse-factor', type=int, default=8,
+    help='downsampling factor of tiles without OSM features (default: 8)')
+    cmdLineParser.add_argument('--balance', action='store_true', help=
+    'split tiles according to their predicted render time, which is derived '
+    'from the feature density of the input GeoPackages')
+    cmdLineParser.add_argument('--balance-tiles', type=int, help='number of '
+    'tiles the predicted render time is balanced over (default: four per job)')
+    cmdLineParser.add_argument('--dry-run', action='store_true', help=
+    'print the tile partitioning and the predicted wall time and peak memory '
+    'without rendering or queueing')
+    cmdLineParser.add_argument('--max-jobs', type=int, default=os.cpu_count(),
+    help='maximum number of external tools running at the same time')
+    cmdLineParser.add_argument('--tool-timeout', type=float, help=
+    'maximum runtime of a single external tool in seconds (default: none)')
+
+    args=cmdLineParser.parse_args(argv)
+
+    if args.role and not args.queue_dir:
+        cmdLineParser.error('--role requires --queue-dir')
+
+    return args
 
 
 ##############################################################################
@@ -138,20 +201,27 @@ def checkToolchain(args):
 
     print('Checking toolchain')
 
+    # query the tools concurrently, results are evaluated below
+    gdalTools=['gdal_translate', 'gdalbuildvrt', 'ogr2ogr', 'ogrinfo']
+    projTool='cs2cs'
+    toolResults=runExecutables([{'args': [args.mapnik_render, '--version']}]+
+    [{'args': [gdalTool, '--version']} for gdalTool in gdalTools]+
+    [{'args': [projTool, '-f',  '%.0f', 'EPSG:4326', 'EPSG:3857'], 
+    'stdinStr': '13 52\n'}], args.max_jobs, progress=None)
+
     #
     # mapnik-render >= 4.0
     #
     mrMinVersion='4.0'
-    mrResult=runExecutable([args.mapnik_render, '--version'])
+    mrResult=toolResults[0]
     mrVersion=mrResult.output.split()        
   
     if len(mrVersion)==2 and mrVersion[0]=='version' and \
     parse_version(mrVersion[1])>=parse_version(mrMinVersion):
         print(args.mapnik_render,'is version', mrVersion[1])
     else:
-        print('Cannot verify that', args.mapnik_render, 
-        'is working properly or matches the minimum required version')
-        sys.exit(1)
+        raise RenderError('Cannot verify that '+args.mapnik_render+
+        ' is working properly or matches the minimum required version', 1)
 
     # check plugins path if given
     # check common places if not (Linux only)    
@@ -168,9 +238,8 @@ def checkToolchain(args):
             print('Manually specified Mapnik plugins under', 
             args.mapnik_plugins, 'look usable, found ', inputPluginsExist)
         else: 
-            print('Cannot find and/or access Mapnik plugins under', 
-            args.mapnik_plugins)
-            sys.exit(1)
+            raise RenderError('Cannot find and/or access Mapnik plugins '
+            'under '+args.mapnik_plugins, 1)
     else:
 
         for pluginPathCandidate in ['/usr/lib64/mapnik/input', 
@@ -197,25 +266,21 @@ def checkToolchain(args):
     #
     gdalMinVersion='3.9'
 
-    for gdalTool in ['gdal_translate', 'ogr2ogr']:
+    for gdalTool, toolResult in zip(gdalTools, toolResults[1:]):
 
-        toolResult=runExecutable([gdalTool, '--version'])
         toolVersion=toolResult.output.replace(",", "").split()        
 
         if len(toolVersion)>=2 and toolVersion[0]=='GDAL' and \
         parse_version(toolVersion[1])>=parse_version(gdalMinVersion):
             print(gdalTool,'is version', toolVersion[1])
         else:
-            print('Cannot verify that', gdalTool, 'is working properly or '\
-            'matches the minimum required version')
-            sys.exit(1)
+            raise RenderError('Cannot verify that '+gdalTool+' is working '
+            'properly or matches the minimum required version', 1)
 
     #
     # PROJ cs2cs
     #
-    projTool='cs2cs'
-    toolResult=runExecutable([projTool, '-f',  '%.0f', 'EPSG:4326', 
-    'EPSG:3857'], '13 52\n')
+    toolResult=toolResults[-1]
     # keep floating-point numbers only
     toolOutputList=re.findall(r"[-+]?(?:\d*\.*\d+)", toolResult.output)
     # remove empty list entries
@@ -225,11 +290,10 @@ def checkToolchain(args):
     toolOutputList[1]=='1459732' and toolOutputList[2]=='0':
         print(projTool, 'is capable of EPSG-based coordinate transforms')
     else:
-        print(projTool, 'cannot perform EPSG-based coordinate transforms.',
-        'Please check your PROJ setup, and set the PROJ_DATA environment',
-        'variable to the PROJ EPSG database (see "Using proj" on',
-        'https://proj.org).')
-        sys.exit(1)
+        raise RenderError(projTool+' cannot perform EPSG-based coordinate '
+        'transforms. Please check your PROJ setup, and set the PROJ_DATA '
+        'environment variable to the PROJ EPSG database (see "Using proj" on '
+        'https://proj.org).', 1)
 
     print('Toolchain checks complete')
 
@@ -262,60 +326,56 @@ def computeOutputDimensions(args):
     # check longitudes and latitudes to be within the Web Mercator range
     if targetCrsName=='WebMercator':
         if args.lonMin<-180 or args.lonMin>180:
-            print('Minimum longitude is out of range, must be -180 ... 180.')
-            sys.exit(2)
+            raise RenderError('Minimum longitude is out of range, must be '
+            '-180 ... 180.', 2)
 
         if args.lonMax<-180 or args.lonMax>180:
-            print('Maximum longitude is out of range, must be -180 ... 180.')
-            sys.exit(2)
+            raise RenderError('Maximum longitude is out of range, must be '
+            '-180 ... 180.', 2)
 
         if args.latMin<-85 or args.latMin>85:
-            print('Minimum latitude is out of range, must be -85 ... 85.')
-            sys.exit(2)
+            raise RenderError('Minimum latitude is out of range, must be '
+            '-85 ... 85.', 2)
  
         if args.latMax<-85 or args.latMax>85:
-            print('Maximum latitude is out of range, must be -85 ... 85.')
-            sys.exit(2)
+            raise RenderError('Maximum latitude is out of range, must be '
+            '-85 ... 85.', 2)
 
     # GSD must be positive
     if args.gsd<=0:
-        print('Target ground sampling distance must be positive')
-        sys.exit(3)
+        raise RenderError('Target ground sampling distance must be '
+        'positive', 3)
 
     #                
-    # transform minimum of extent into target CRS
+    # transform minimum and maximum of extent into target CRS with a 
+    # single cs2cs run, one line each
     #
 
     toolResult=runExecutable(['cs2cs', '-f',  '%.10f', srcCrsStr, 
-    targetCrsStr], str(args.latMin)+' '+str(args.lonMin)+'\n')
+    targetCrsStr], str(args.latMin)+' '+str(args.lonMin)+'\n'+
+    str(args.latMax)+' '+str(args.lonMax)+'\n')
+    toolOutputLines=toolResult.output.splitlines()+['', '']
+
     # keep floating-point numbers only
-    toolOutputList=re.findall(r"[-+]?(?:\d*\.*\d+)", toolResult.output)
+    toolOutputList=re.findall(r"[-+]?(?:\d*\.*\d+)", toolOutputLines[0])
     # remove empty list entries
     toolOutputList=[x for x in toolOutputList if x]
 
     if len(toolOutputList)!=3:
-            print('Error while transforming minimum of extent to',targetCrsName,
-            'target CRS')
-            sys.exit(3)
+            raise RenderError('Error while transforming minimum of extent to '+
+            targetCrsName+' target CRS', 3)
 
     targetMinX=float(toolOutputList[0])
     targetMinY=float(toolOutputList[1])
 
-    #                
-    # transform maximum of extent into target CRS
-    #
-
-    toolResult=runExecutable(['cs2cs', '-f',  '%.10f', srcCrsStr, 
-    targetCrsStr], str(args.latMax)+' '+str(args.lonMax)+'\n')
     # keep floating-point numbers only
-    toolOutputList=re.findall(r"[-+]?(?:\d*\.*\d+)", toolResult.output)
+    toolOutputList=re.findall(r"[-+]?(?:\d*\.*\d+)", toolOutputLines[1])
     # remove empty list entries
     toolOutputList=[x for x in toolOutputList if x]
 
     if len(toolOutputList)!=3:
-            print('Error while transforming maximum of extent to',targetCrsName,
-            'target CRS')
-            sys.exit(3)
+            raise RenderError('Error while transforming maximum of extent to '+
+            targetCrsName+' target CRS', 3)
 
     targetMaxX=float(toolOutputList[0])
     targetMaxY=float(toolOutputList[1])
@@ -325,9 +385,8 @@ def computeOutputDimensions(args):
     vDist=targetMaxY-targetMinY
 
     if hDist<0 or vDist<0:
-        print('Horizontal or vertical extent dimensions negative, please '
-        're-check order of coordinates and their signs')
-        sys.exit(3)
+        raise RenderError('Horizontal or vertical extent dimensions negative, '
+        'please re-check order of coordinates and their signs', 3)
 
     #
     # compute image dimensions from metric extent and GSD
@@ -398,7 +457,438 @@ def computeOutputDimensions(args):
 ##############################################################################
 
 
-def modifyXmlTemplates(args, mapnikGsd):
+def evictCachedFiles(cacheDir, cacheSizeLimit, requiredSize, runStartTime):
+    """
+    Removes the least recently used GeoPackages from the local cache until
+    the cache plus the file to be added fits into the size limit. Copies
+    used since the current render started are kept, they may be in use by
+    this or a concurrent render.
+
+    Args:
+        cacheDir: the cache directory
+        cacheSizeLimit: the maximum total size of the cache in bytes
+        requiredSize: the size of the file to be added in bytes
+        runStartTime: the start time of the current render
+    """
+
+    cachedFiles=[]
+    for fileName in os.listdir(cacheDir):
+        filePath=os.path.join(cacheDir, fileName)
+        if fileName.endswith('.gpkg'):
+            try:
+                fileStat=os.stat(filePath)
+            except OSError:
+                continue
+            cachedFiles.append((fileStat.st_mtime, fileStat.st_size, filePath))
+
+    cacheSize=sum(fileSize for _, fileSize, _ in cachedFiles)
+
+    # the modification time is updated on each use, oldest first
+    for fileTime, fileSize, filePath in sorted(cachedFiles):
+        if cacheSize+requiredSize<=cacheSizeLimit:
+            break
+
+        if fileTime>=runStartTime:
+            print('Keeping', filePath, 'in GeoPackage cache, it is in use')
+            continue
+
+        print('Evicting', filePath, 'from GeoPackage cache')
+        try:
+            os.remove(filePath)
+            cacheSize-=fileSize
+        except OSError:
+            pass
+
+
+##############################################################################
+
+
+def cacheGpkgFile(gpkgFile, cacheDir, cacheSizeLimit, runStartTime):
+    """
+    Provides an uncompressed copy of the input GeoPackage on local disk so
+    Mapnik does not need to perform random reads through the zip archive
+    or over network storage. Copies are identified by the path, size and
+    modification time of the input, and the least recently used copies are
+    evicted when the cache exceeds its size limit.
+
+    Args:
+        gpkgFile: the input GeoPackage, may be zipped with a single GPKG in
+                  the archive
+        cacheDir: the local cache directory, will be created if necessary
+        cacheSizeLimit: the maximum total size of the cache in bytes
+        runStartTime: the start time of the current render, copies used
+                      since then are not evicted
+
+    Returns:
+        The path to the cached copy, or the input GeoPackage itself if it
+        cannot be cached
+    """
+
+    try:
+        gpkgStat=os.stat(gpkgFile)
+    except OSError:
+        print('Cannot access', gpkgFile, 'for caching')
+        return gpkgFile
+
+    cacheKey=hashlib.sha256((os.path.abspath(gpkgFile)+'|'+
+    str(gpkgStat.st_size)+'|'+str(gpkgStat.st_mtime_ns)).encode('utf-8')).\
+    hexdigest()[:24]
+    cachedFile=os.path.join(os.path.abspath(cacheDir), cacheKey+'.gpkg')
+
+    # cache hit, mark as recently used; a copy just evicted by a concurrent
+    # render is a cache miss
+    try:
+        os.utime(cachedFile)
+        print('Using cached copy', cachedFile, 'of', gpkgFile)
+        return cachedFile
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        print('Cannot use cached copy', cachedFile, '(', exc, ')')
+
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+
+        # only a single GeoPackage is supported inside archives
+        if zipfile.is_zipfile(gpkgFile):
+            with zipfile.ZipFile(gpkgFile) as archive:
+                members=[member for member in archive.infolist() if 
+                member.filename.lower().endswith('.gpkg')]
+
+                if len(members)!=1:
+                    print('Expected a single GeoPackage in', gpkgFile, 
+                    'but found', len(members), '- not caching')
+                    return gpkgFile
+
+                requiredSize=members[0].file_size
+        else:
+            requiredSize=gpkgStat.st_size
+
+        if requiredSize>cacheSizeLimit:
+            print('GeoPackage', gpkgFile, 'exceeds the cache size limit, '
+            'rendering from the original file')
+            return gpkgFile
+
+        evictCachedFiles(cacheDir, cacheSizeLimit, requiredSize, runStartTime)
+
+        # concurrent renders may fill in the same copy, each one writes 
+        # its own temporary file and the last rename wins
+        print('Caching', gpkgFile, 'as', cachedFile)
+        copyStartTime=time.time()
+        tempFd, tempFile=tempfile.mkstemp(suffix='.partial', dir=cacheDir)
+
+        try:
+            with os.fdopen(tempFd, 'wb') as target:
+                if zipfile.is_zipfile(gpkgFile):
+                    with zipfile.ZipFile(gpkgFile) as archive:
+                        with archive.open(members[0]) as source:
+                            shutil.copyfileobj(source, target, 1<<24)
+                else:
+                    with open(gpkgFile, 'rb') as source:
+                        shutil.copyfileobj(source, target, 1<<24)
+
+            os.replace(tempFile, cachedFile)
+        except BaseException:
+            removeFiles([tempFile])
+            raise
+
+    except (OSError, zipfile.BadZipFile) as exc:
+        print('Caching', gpkgFile, 'failed (', exc, '), rendering from the '
+        'original file')
+        return gpkgFile
+
+    print('Cached', requiredSize, 'bytes in', int(time.time()-copyStartTime),
+    'seconds')
+
+    return cachedFile
+
+
+##############################################################################
+
+
+def parseJsonOutput(toolResult):
+    """
+    Extracts the JSON document printed by a GDAL tool, which may be preceded
+    or followed by warnings since stdout and stderr are merged.
+
+    Args:
+        toolResult: the result of the tool run
+
+    Returns:
+        The deserialized JSON document, or None if the tool failed or did
+        not print a valid document
+    """
+
+    output=toolResult.output
+    jsonStart=output.find('{')
+    jsonEnd=output.rfind('}')
+
+    if toolResult.exitCode!=0 or jsonStart<0 or jsonEnd<jsonStart:
+        return None
+
+    try:
+        return json.loads(output[jsonStart:jsonEnd+1])
+    except ValueError:
+        return None
+
+
+##############################################################################
+
+
+def parseGpkgExtent(toolResult, gpkgFile):
+    """
+    Extracts the common extent of all feature layers of a GeoPackage from
+    the JSON summary printed by ogrinfo.
+
+    Args:
+        toolResult: the result of "ogrinfo -json -so" for the GeoPackage
+        gpkgFile: the path to the GeoPackage
+
+    Returns:
+        The extent as a floating-point lonMin, latMin, lonMax, latMax list,
+        or None if it cannot be determined
+    """
+
+    try:
+        layerExtents=[geometryField['extent'] for layer in parseJsonOutput(
+        toolResult)['layers'] for geometryField in layer.get(
+        'geometryFields', []) if geometryField.get('extent')]
+    except (KeyError, TypeError):
+        layerExtents=[]
+
+    if not layerExtents:
+        print('Cannot determine the extent of', gpkgFile)
+        return None
+
+    return [min(e[0] for e in layerExtents), min(e[1] for e in layerExtents),
+    max(e[2] for e in layerExtents), max(e[3] for e in layerExtents)]
+
+
+##############################################################################
+
+
+def collectGpkgInputs(gpkgInputs, maxJobs):
+    """
+    Expands the input GeoPackages and directories of GeoPackages into a list
+    of GeoPackages with their extents. The extents of directory contents are
+    kept in a "lulc_index.json" file inside the directory (if writable) and
+    only queried again for new or modified GeoPackages.
+
+    Args:
+        gpkgInputs: list of GeoPackage files and directories
+        maxJobs: the maximum number of concurrent ogrinfo queries
+
+    Returns:
+        A list of [path, extent] pairs, the extent being None if unknown
+    """
+
+    indexFileName='lulc_index.json'
+
+    gpkgFiles=[]
+    indexes={}
+
+    for gpkgInput in gpkgInputs:
+        if not os.path.isdir(gpkgInput):
+            gpkgFiles.append(gpkgInput)
+            continue
+
+        try:
+            indexes[gpkgInput]=readJsonFile(os.path.join(gpkgInput, 
+            indexFileName))
+        except (OSError, ValueError):
+            indexes[gpkgInput]={}
+
+        gpkgFiles+=[os.path.join(gpkgInput, f) for f in sorted(os.listdir(
+        gpkgInput)) if f.lower().endswith(('.gpkg', '.gpkg.zip'))]
+
+    #
+    # look up extents in the directory indexes, query the rest concurrently
+    #
+    extents={}
+    queryFiles=[]
+
+    for gpkgFile in gpkgFiles:
+        gpkgDir, gpkgName=os.path.split(gpkgFile)
+        entry=indexes.get(gpkgDir, {}).get(gpkgName)
+        gpkgStat=os.stat(gpkgFile)
+
+        if entry and entry['size']==gpkgStat.st_size and entry['mtime']==\
+        gpkgStat.st_mtime_ns:
+            extents[gpkgFile]=entry['extent']
+        else:
+            queryFiles.append(gpkgFile)
+
+    if queryFiles:
+        print('Querying extents of', len(queryFiles), 'GeoPackages')
+
+    toolResults=runExecutables([{'args': ['ogrinfo', '-ro', '-so', '-json', 
+    gpkgFile]} for gpkgFile in queryFiles], maxJobs, progress=None)
+
+    for gpkgFile, toolResult in zip(queryFiles, toolResults):
+        extents[gpkgFile]=parseGpkgExtent(toolResult, gpkgFile)
+
+        gpkgDir, gpkgName=os.path.split(gpkgFile)
+        if gpkgDir in indexes and extents[gpkgFile]:
+            gpkgStat=os.stat(gpkgFile)
+            indexes[gpkgDir][gpkgName]={'size': gpkgStat.st_size, 'mtime': 
+            gpkgStat.st_mtime_ns, 'extent': extents[gpkgFile]}
+
+    # update indexes, may be read-only
+    for gpkgDir, index in indexes.items():
+        try:
+            writeJsonFile(os.path.join(gpkgDir, indexFileName), index)
+        except OSError:
+            pass
+
+    return [[gpkgFile, extents[gpkgFile]] for gpkgFile in gpkgFiles]
+
+
+##############################################################################
+
+
+def writeUnionDatasource(gpkgFiles, extent, workDir, timeout=None):
+    """
+    Writes a local GeoPackage combining the layers of several GeoPackages
+    into layers of the same name. Only features within the extent are read
+    from the GeoPackages, and OSM features contained in more than one 
+    GeoPackage, e.g., along the borders of regional extracts, are passed on
+    once by their OSM IDs. The union is materialized once per render since
+    OGR cannot pass the spatial filters of Mapnik's layer queries on to the
+    deduplicating SQL of a VRT, which would run again for every query.
+
+    Args:
+        gpkgFiles: the list of GeoPackages
+        extent: the render extent as a lonMin, latMin, lonMax, latMax list
+        workDir: the directory to write the union datasource to
+        timeout: the maximum runtime of ogr2ogr in seconds, None for no 
+                 limit
+
+    Returns:
+        The path to the GeoPackage to be rendered
+    """
+
+    [lonMin, latMin, lonMax, latMax]=extent
+    regionWkt='POLYGON(('+', '.join(f'{lon} {lat}' for lon, lat in [(lonMin,
+    latMin), (lonMax, latMin), (lonMax, latMax), (lonMin, latMax), (lonMin, 
+    latMin)])+'))'
+
+    # layer names and the OSM ID columns used to remove duplicates, the
+    # polygons of the base and water layers are identical in all extracts
+    # and therefore rendered as-is
+    unionLayers=[('multipolygons', 'osm_id, osm_way_id'), ('lines', 
+    'osm_id'), ('points', 'osm_id'), ('multipolygons_baselayer', None), 
+    ('multipolygons_water', None)]
+
+    unionVrt=os.path.join(os.path.abspath(workDir), 'union.vrt')
+    datasourceVrt=os.path.join(os.path.abspath(workDir), 'datasource.vrt')
+    unionGpkg=os.path.join(os.path.abspath(workDir), 'union.gpkg')
+
+    with open(unionVrt, 'w', encoding='utf-8') as target:
+        target.write('<OGRVRTDataSource>\n')
+
+        for layerName, _ in unionLayers:
+            target.write('  <OGRVRTUnionLayer name="'+layerName+'">\n')
+
+            for gpkgIndex, gpkgFile in enumerate(gpkgFiles):
+                target.write('    <OGRVRTLayer name="'+layerName+'_'+
+                str(gpkgIndex)+'">\n      <SrcDataSource>'+xmlEscape(
+                os.path.abspath(gpkgFile))+'</SrcDataSource>\n'
+                '      <SrcLayer>'+layerName+'</SrcLayer>\n'
+                '      <SrcRegion clip="false">'+regionWkt+'</SrcRegion>\n'
+                '    </OGRVRTLayer>\n')
+
+            target.write('  </OGRVRTUnionLayer>\n')
+
+        target.write('</OGRVRTDataSource>\n')
+
+    with open(datasourceVrt, 'w', encoding='utf-8') as target:
+        target.write('<OGRVRTDataSource>\n')
+
+        for layerName, idColumns in unionLayers:
+            target.write('  <OGRVRTLayer name="'+layerName+'">\n'
+            '    <SrcDataSource>'+xmlEscape(unionVrt)+'</SrcDataSource>\n')
+
+            if idColumns:
+                target.write('    <SrcSQL dialect="sqlite">SELECT * FROM '+
+                layerName+' GROUP BY '+idColumns+'</SrcSQL>\n')
+            else:
+                target.write('    <SrcLayer>'+layerName+'</SrcLayer>\n')
+
+            target.write('  </OGRVRTLayer>\n')
+
+        target.write('</OGRVRTDataSource>\n')
+
+    print('Writing the union of', len(gpkgFiles), 'GeoPackages to', 
+    unionGpkg)
+
+    toolResult=runExecutable(['ogr2ogr', '-f', 'GPKG', '-gt', '65536', 
+    unionGpkg, datasourceVrt], printCmdLine=True, streamOutput=True, 
+    timeout=timeout, tempFiles=[unionGpkg])
+
+    if toolResult.exitCode!=0:
+        raise RenderError('Writing the union of the input GeoPackages '
+        'failed', 3)
+
+    return unionGpkg
+
+
+##############################################################################
+
+
+def prepareDatasource(args, extent, workDir, queryOnly=False):
+    """
+    Determines the datasource to be rendered from the input GeoPackages and
+    stores it in args.gpkgFile, and the GeoPackages it reads from in 
+    args.gpkgSources. GeoPackages not intersecting the render
+    extent are skipped, several intersecting GeoPackages are combined into
+    a union datasource, and GeoPackages are cached locally if requested.
+
+    Args:
+        args: the parsed command line arguments        
+        extent: the render extent as a lonMin, latMin, lonMax, latMax list
+        workDir: the directory to write the union datasource to
+        queryOnly: the GeoPackages are only queried, e.g., for 
+                   partitioning, so they are neither cached nor combined
+                   into a union datasource
+    """
+
+    # a single GeoPackage is used as-is
+    if len(args.gpkgFiles)==1 and not os.path.isdir(args.gpkgFiles[0]):
+        gpkgFiles=args.gpkgFiles
+    else:
+        [lonMin, latMin, lonMax, latMax]=extent
+
+        gpkgFiles=[gpkgFile for gpkgFile, gpkgExtent in collectGpkgInputs(
+        args.gpkgFiles, args.max_jobs) if gpkgExtent is None or (
+        gpkgExtent[0]<=lonMax and gpkgExtent[2]>=lonMin and gpkgExtent[1]<=
+        latMax and gpkgExtent[3]>=latMin)]
+
+        if not gpkgFiles:
+            raise RenderError('None of the input GeoPackages intersects the '
+            'render extent', 3)
+
+        print('Rendering from', len(gpkgFiles), 'GeoPackages intersecting '
+        'the render extent:', ', '.join(gpkgFiles))
+
+    # work on local uncompressed copies of the inputs if requested
+    if args.cache_dir and not queryOnly:
+        runStartTime=time.time()
+        gpkgFiles=[cacheGpkgFile(gpkgFile, args.cache_dir, int(
+        args.cache_size*(1<<30)), runStartTime) for gpkgFile in gpkgFiles]
+
+    args.gpkgSources=gpkgFiles
+
+    if len(gpkgFiles)==1 or queryOnly:
+        args.gpkgFile=gpkgFiles[0]
+    else:
+        args.gpkgFile=writeUnionDatasource(gpkgFiles, extent, workDir,
+        args.tool_timeout)
+
+
+##############################################################################
+
+
+def modifyXmlTemplates(args, mapnikGsd, targetDir=None):
     """
     Modifies XML template files to produce the final include files that
     configure the Mapnik style sheet using the XML entity mechanism.
@@ -406,11 +896,32 @@ def modifyXmlTemplates(args, mapnikGsd):
     Args:
         args: the parsed command line arguments        
         mapnikGsd: the (unscaled) Mapnik GSD in pixels per meter
+        targetDir: directory to receive a private copy of the style sheet
+                   and its include files, e.g., for concurrent renders with 
+                   different settings; None to modify the include files 
+                   next to the style sheet
+
+    Returns:
+        The path to the style sheet to be rendered
     """
 
     # extract style sheet path; this is where the include files should 
     # also be located
     ssPath=os.path.dirname(args.mapnik_style_sheet)
+    styleSheet=args.mapnik_style_sheet
+
+    # copy style sheet and include files, the templates are altered there
+    if targetDir:
+        os.makedirs(targetDir, exist_ok=True)
+
+        for fileName in os.listdir(ssPath or '.'):
+            if fileName.endswith(('.inc', '.inc.template')):
+                shutil.copyfile(os.path.join(ssPath, fileName), 
+                os.path.join(targetDir, fileName))
+
+        styleSheet=os.path.join(targetDir, os.path.basename(styleSheet))
+        shutil.copyfile(args.mapnik_style_sheet, styleSheet)
+        ssPath=targetDir
 
 
     #
@@ -461,19 +972,21 @@ def modifyXmlTemplates(args, mapnikGsd):
             # write
             target.write(line)
 
+    return styleSheet
 
 
 ##############################################################################
 
 
 def renderLULC(args, mapWidth, mapHeight, targetMinX, targetMinY, targetMaxX, 
-targetMaxY):
+targetMaxY, outImage=None, styleSheet=None, margin=0, outputPrefix='',
+translateOptions=None, streamOutput=True):
 
     """
     Renders a Mapnik XML style sheet into a geo-referenced image of the given
     dimensions that covers the passed extent in target CRS coordinates. The
     file format and other output settings are taken from the command-line
-    arguments in the args variable.
+    arguments in the args variable unless given explicitly.
 
     Args:
         args: the parsed command line arguments        
@@ -487,19 +1000,39 @@ targetMaxY):
         rendered, expressed in the target CRS
         targetMaxY: the maximum vertical coordinate of the extent to be
         rendered, expressed in the target CRS
+        outImage: the output image, defaults to the one from the command
+        line
+        styleSheet: the Mapnik style sheet, defaults to the one from the
+        command line
+        margin: number of pixels the extent is enlarged by on each side for 
+        rendering and cropped again afterwards, so features just outside
+        the extent are considered, e.g., at tile boundaries
+        outputPrefix: text put in front of each line of the tool output
+        translateOptions: additional gdal_translate options, e.g., to 
+        select the output format
+        streamOutput: echo the tool output to the console, otherwise the
+        last lines of the output are only reported on failure
     """
 
+    outImage=outImage or args.outImage
+    styleSheet=styleSheet or args.mapnik_style_sheet
+
     # tempdir is output directory
-    splitPath=os.path.split(os.path.abspath(args.outImage))
-    pngImage=args.outImage+'.png'
+    pngImage=outImage+'.png'
+
+    # extent to be rendered including the margin
+    pixelWidth=(targetMaxX-targetMinX)/mapWidth
+    pixelHeight=(targetMaxY-targetMinY)/mapHeight
 
     #
     # run Mapnik
     #
     mapnikCmdline=[args.mapnik_render, '--verbose', '--variables', 
-    '--map-width', str(mapWidth), '--map-height', str(mapHeight), '--bbox',
-    str(targetMinX)+','+str(targetMinY)+','+str(targetMaxX)+','+
-    str(targetMaxY), '--img', pngImage, '--xml', args.mapnik_style_sheet]
+    '--map-width', str(mapWidth+2*margin), '--map-height', 
+    str(mapHeight+2*margin), '--bbox', str(targetMinX-margin*pixelWidth)+','+
+    str(targetMinY-margin*pixelHeight)+','+str(targetMaxX+margin*pixelWidth)+
+    ','+str(targetMaxY+margin*pixelHeight), '--img', pngImage, '--xml', 
+    styleSheet]
 
     if args.mapnik_plugins:
         mapnikCmdline.append('--plugins-dir')
@@ -508,14 +1041,20 @@ targetMaxY):
     print('Rendering started')
     renderStartTime=time.time()
 
-    mapnikResult=runExecutable(mapnikCmdline, printCmdLine=True)
-    print(mapnikResult.output)
+    mapnikResult=runExecutable(mapnikCmdline, printCmdLine=True, 
+    streamOutput=streamOutput, timeout=args.tool_timeout, tempFiles=[
+    pngImage], outputPrefix=outputPrefix)
     renderEndTime=time.time()
 
-    if mapnikResult.exitCode!=0:
-        print(args.mapnik_render, 'exited abnormally with code', 
-        mapnikResult.exitCode)
-        sys.exit(4)
+    if mapnikResult.exitCode!=0 and not streamOutput:
+        print(mapnikResult.output[-2000:])
+
+    if mapnikResult.timedOut:
+        raise RenderError(args.mapnik_render+' got terminated after '
+        'exceeding the timeout of '+str(args.tool_timeout)+' seconds', 4)
+    elif mapnikResult.exitCode!=0:
+        raise RenderError(args.mapnik_render+' exited abnormally with code '+
+        str(mapnikResult.exitCode), 4)
     else: 
         print(args.mapnik_render, 'exited normally after', 
         int(renderEndTime-renderStartTime), 'seconds')
@@ -524,17 +1063,30 @@ targetMaxY):
     # add georefs
     #    
     print('')
-    print('Converting', pngImage, 'to target', args.outImage)
+    print('Converting', pngImage, 'to target', outImage)
 
-    gdalResult=runExecutable(['gdal_translate', '-a_ullr', str(targetMinX), 
+    gdalCmdline=['gdal_translate', '-a_ullr', str(targetMinX), 
     str(targetMaxY), str(targetMaxX), str(targetMinY), '-a_srs', 'EPSG:3857', 
-    pngImage, args.outImage], printCmdLine=True)
-    print(gdalResult.output)
+    pngImage, outImage]
+
+    # crop margin
+    if margin:
+        gdalCmdline[1:1]=['-srcwin', str(margin), str(margin), str(mapWidth),
+        str(mapHeight)]
+
+    if translateOptions:
+        gdalCmdline[1:1]=translateOptions
+
+    gdalResult=runExecutable(gdalCmdline, printCmdLine=True, 
+    streamOutput=streamOutput, timeout=args.tool_timeout, tempFiles=[
+    outImage], outputPrefix=outputPrefix)
 
     if gdalResult.exitCode!=0:
-        print('gdal_translate exited abnormally with code', 
-        gdalResult.exitCode)
-        sys.exit(4)
+        if not streamOutput:
+            print(gdalResult.output[-2000:])
+        removeFiles([pngImage])
+        raise RenderError('gdal_translate exited abnormally with code '+
+        str(gdalResult.exitCode), 4)
     else: 
         print('gdal_translate exited normally')
 
@@ -545,28 +1097,1355 @@ targetMaxY):
 ##############################################################################
 
 
-def main(args):
+def splitIntoTiles(imageWidth, imageHeight, tileSize):
     """
-    The entry point controls the render workflow on a high level.
+    Splits the output image into a regular grid of tiles.
 
     Args:
-        args: the parsed command line arguments        
+        imageWidth: the width of the output image in pixels
+        imageHeight: the height of the output image in pixels
+        tileSize: the maximum tile width and height in pixels
+
+    Returns:
+        The list of tiles as dictionaries with the pixel offsets "x" and "y"
+        and the pixel dimensions "width" and "height" of each tile
     """
 
-    # check for working toolchain
-    checkToolchain(args)
+    tiles=[]
 
-    # compute output image dimensions
-    [imageWidth, imageHeight, mapnikGsd, targetMinX, targetMinY, targetMaxX, 
-    targetMaxY]=computeOutputDimensions(args)
+    for y in range(0, imageHeight, tileSize):
+        for x in range(0, imageWidth, tileSize):
+            tiles.append({'x': x, 'y': y, 'width': min(tileSize, 
+            imageWidth-x), 'height': min(tileSize, imageHeight-y)})
+
+    return tiles
+
+
+##############################################################################
+
+
+def computeTileExtent(queueInfo, tile):
+    """
+    Computes the extent of a tile in target CRS coordinates from its pixel
+    window, so adjacent tiles share their boundaries exactly.
+
+    Args:
+        queueInfo: the tile queue description
+        tile: the tile as a dictionary with pixel offsets and dimensions
+
+    Returns:
+        The extent of the tile as a minX, minY, maxX, maxY list
+    """
+
+    [targetMinX, targetMinY, targetMaxX, targetMaxY]=queueInfo['targetExtent']
+    pixelWidth=(targetMaxX-targetMinX)/queueInfo['imageWidth']
+    pixelHeight=(targetMaxY-targetMinY)/queueInfo['imageHeight']
+
+    return [targetMinX+tile['x']*pixelWidth, 
+    targetMaxY-(tile['y']+tile['height'])*pixelHeight,
+    targetMinX+(tile['x']+tile['width'])*pixelWidth,
+    targetMaxY-tile['y']*pixelHeight]
+
+
+##############################################################################
+
+
+def writeJsonFile(fileName, data):
+    """
+    Atomically writes a JSON file, so readers on other nodes never see a 
+    partially written file.
+
+    Args:
+        fileName: the path to the JSON file
+        data: the data to be serialized
+    """
+
+    partialFile=fileName+'.'+socket.gethostname()+'_'+str(os.getpid())+\
+    '.partial'
+
+    with open(partialFile, 'w') as target:
+        json.dump(data, target, indent=2)
+
+    os.replace(partialFile, fileName)
+
+
+##############################################################################
+
+
+def readJsonFile(fileName):
+    """
+    Reads a JSON file.
+
+    Args:
+        fileName: the path to the JSON file
+
+    Returns:
+        The deserialized data
+    """
+
+    with open(fileName, 'r') as source:
+        return json.load(source)
+
+
+##############################################################################
+
+
+def countDoneTiles(queueDir):
+    """
+    Counts the completed tiles of the queue.
 
-    # modify XML entities in the default templates
-    if not args.no_templates:
-        modifyXmlTemplates(args, mapnikGsd)
+    Args:
+        queueDir: the queue directory
+
+    Returns:
+        The number of completed tiles
+    """
+
+    return len([f for f in os.listdir(os.path.join(queueDir, 'done')) if 
+    re.fullmatch(r'\d+\.tif', f)])
+
+
+##############################################################################
 
-    # render!
-    renderLULC(args, imageWidth, imageHeight, targetMinX, targetMinY, 
-    targetMaxX, targetMaxY)
+
+def queryGpkgRows(args, gpkgFiles, sqlStatements, workDir):
+    """
+    Runs SQL queries on GeoPackages with ogrinfo, one per GeoPackage and
+    concurrently, and returns the resulting rows. The statements are
+    passed through files since they may exceed command line limits. The
+    output of ogrinfo is kept in memory, so queries should aggregate their
+    results rather than return feature rows.
+
+    Args:
+        args: the parsed command line arguments        
+        gpkgFiles: the list of GeoPackages
+        sqlStatements: the list of SQL statements, one per GeoPackage
+        workDir: the directory to write the SQL files to
+
+    Returns:
+        A list containing the rows of each GeoPackage as dictionaries
+        indexed by column name, or None for a failed query
+    """
+
+    sqlFiles=[]
+    for sqlIndex, sqlStatement in enumerate(sqlStatements):
+        sqlFiles.append(os.path.join(workDir, 'query_'+str(sqlIndex)+'.sql'))
+        with open(sqlFiles[-1], 'w') as target:
+            target.write(sqlStatement)
+
+    toolResults=runExecutables([{'args': ['ogrinfo', '-ro', '-json', 
+    '-features', '-sql', '@'+sqlFile, gpkgFile]} for gpkgFile, sqlFile in 
+    zip(gpkgFiles, sqlFiles)], args.max_jobs, progress=None)
+
+    removeFiles(sqlFiles)
+
+    gpkgRows=[]
+    for gpkgFile, toolResult in zip(gpkgFiles, toolResults):
+        toolJson=parseJsonOutput(toolResult)
+
+        if toolJson is None:
+            print('Querying', gpkgFile, 'failed:', toolResult.output[-1000:])
+            gpkgRows.append(None)
+        else:
+            gpkgRows.append([feature['properties'] for layer in toolJson.get(
+            'layers', []) for feature in layer.get('features', [])])
+
+    return gpkgRows
+
+
+##############################################################################
+
+
+def mercatorToLonLat(x, y):
+    """
+    Converts Web Mercator coordinates into geodetic WGS84 coordinates.
+
+    Args:
+        x: the horizontal Web Mercator coordinate in meters
+        y: the vertical Web Mercator coordinate in meters
+
+    Returns:
+        The longitude and latitude in degrees as a list
+    """
+
+    earthRadius=6378137.0
+
+    return [math.degrees(x/earthRadius), math.degrees(2*math.atan(math.exp(
+    y/earthRadius))-math.pi/2)]
+
+
+##############################################################################
+
+
+def queryFeatureGrid(args, layout, cellSize, layerGroups, workDir, 
+countVertices=False):
+    """
+    Counts the features of the input GeoPackages within the cells of a
+    regular grid over the output image using the R-tree spatial indexes of 
+    the GeoPackages. The cells are enlarged by the tile margin, so wide 
+    features just outside a cell are counted as well. Features spanning 
+    several cells are counted once for each cell.
+
+    Args:
+        args: the parsed command line arguments, args.gpkgSources holding 
+              the GeoPackages to be queried
+        layout: dictionary with the "targetExtent", "imageWidth" and 
+                "imageHeight" of the output image
+        cellSize: the width and height of the grid cells in pixels
+        layerGroups: dictionary mapping the names of layer groups to lists
+                     of layer names, counts are accumulated per group
+        workDir: the directory for temporary files
+        countVertices: also estimate the vertex totals from the sizes of 
+                       the geometries, which requires reading them
+
+    Returns:
+        A dictionary mapping the (column, row) grid indices of non-empty
+        cells to dictionaries with the "features" and "vertices" counts per 
+        layer group, or None if the GeoPackages could not be queried
+    """
+
+    [targetMinX, targetMinY, targetMaxX, targetMaxY]=layout['targetExtent']
+    pixelWidth=(targetMaxX-targetMinX)/layout['imageWidth']
+    pixelHeight=(targetMaxY-targetMinY)/layout['imageHeight']
+    margin=args.tile_margin
+
+    #
+    # geodetic cell boundaries, latitudes are not linear in Web Mercator
+    #
+    gridColumns=[]
+    for i in range(math.ceil(layout['imageWidth']/cellSize)):
+        lonMin=mercatorToLonLat(targetMinX+(i*cellSize-margin)*pixelWidth, 0)[0]
+        lonMax=mercatorToLonLat(targetMinX+(min((i+1)*cellSize, 
+        layout['imageWidth'])+margin)*pixelWidth, 0)[0]
+        gridColumns.append(f'SELECT {i} AS i, {lonMin!r} AS lon0, '
+        f'{lonMax!r} AS lon1')
+
+    gridRows=[]
+    for j in range(math.ceil(layout['imageHeight']/cellSize)):
+        latMax=mercatorToLonLat(0, targetMaxY-(j*cellSize-margin)*
+        pixelHeight)[1]
+        latMin=mercatorToLonLat(0, targetMaxY-(min((j+1)*cellSize, 
+        layout['imageHeight'])+margin)*pixelHeight)[1]
+        gridRows.append(f'SELECT {j} AS j, {latMin!r} AS lat0, '
+        f'{latMax!r} AS lat1')
+
+    columnsSql='('+' UNION ALL '.join(gridColumns)+') AS cx'
+    rowsSql='('+' UNION ALL '.join(gridRows)+') AS cy'
+
+    #
+    # the R-tree tables are named after the geometry columns
+    #
+    gpkgFiles=args.gpkgSources
+    geometryRows=queryGpkgRows(args, gpkgFiles, ['SELECT table_name, '
+    'column_name FROM gpkg_geometry_columns']*len(gpkgFiles), workDir)
+
+    if None in geometryRows:
+        return None
+
+    sqlStatements=[]
+    for rows in geometryRows:
+        geometryColumns={row['table_name']: row['column_name'] for row in rows}
+        layerSelects=[]
+
+        for groupName, layerNames in layerGroups.items():
+            for layerName in layerNames:
+                if layerName not in geometryColumns:
+                    continue
+
+                rtreeName=f'rtree_{layerName}_{geometryColumns[layerName]}'
+
+                # WKB takes 16 bytes per 2D vertex
+                verticesSql='0'
+                featureJoin=''
+                if countVertices:
+                    verticesSql=(f'SUM(LENGTH(t."{geometryColumns[layerName]}"'
+                    '))/16')
+                    featureJoin=f' JOIN "{layerName}" AS t ON t.ROWID=r.id'
+
+                # cross joins force the R-tree to be searched per cell
+                layerSelects.append(f"SELECT '{groupName}' AS grp, cx.i AS "
+                f"i, cy.j AS j, COUNT(*) AS n, {verticesSql} AS v FROM "
+                f"{columnsSql} CROSS JOIN {rowsSql} CROSS JOIN \"{rtreeName}"
+                f"\" AS r{featureJoin} WHERE r.maxx>=cx.lon0 AND r.minx<="
+                f"cx.lon1 AND r.maxy>=cy.lat0 AND r.miny<=cy.lat1 GROUP BY "
+                f"cx.i, cy.j")
+
+        # only one row per cell and layer group is returned
+        if layerSelects:
+            sqlStatements.append('SELECT grp, i, j, SUM(n) AS n, SUM(v) AS v '
+            'FROM ('+' UNION ALL '.join(layerSelects)+') GROUP BY grp, i, j')
+        else:
+            sqlStatements.append("SELECT '' AS grp, 0 AS i, 0 AS j, 0 AS n, "
+            "0 AS v")
+
+    print('Counting features in', len(gridColumns), 'x', len(gridRows), 
+    'grid cells of', len(gpkgFiles), 'GeoPackage(s)')
+    countRows=queryGpkgRows(args, gpkgFiles, sqlStatements, workDir)
+
+    if None in countRows:
+        return None
+
+    # accumulate over GeoPackages and layers
+    featureGrid={}
+    for rows in countRows:
+        for row in rows:
+            if row['n']:
+                groupCounts=featureGrid.setdefault((row['i'], row['j']), 
+                {}).setdefault(row['grp'], {'features': 0, 'vertices': 0})
+                groupCounts['features']+=row['n']
+                groupCounts['vertices']+=row['v'] or 0
+
+    return featureGrid
+
+
+##############################################################################
+
+
+def estimateTileCost(args, tile, featureCounts):
+    """
+    Predicts the render time and memory of a tile with a simple linear 
+    model of the rendered pixels, features and vertices, see the cost model
+    constants at the top of the script for their units and calibration.
+
+    Args:
+        args: the parsed command line arguments        
+        tile: the tile as a dictionary with pixel dimensions and scale, and
+              optionally the "margin" rendered around it
+        featureCounts: dictionary with the "features" and "vertices" 
+                       counts of all layers within the tile
+
+    Returns:
+        The predicted render time in seconds and peak memory in bytes
+    """
+
+    scale=tile.get('scale', 1)
+    margin=tile.get('margin', args.tile_margin) if scale==1 else 0
+    renderedPixels=(math.ceil(tile['width']/scale)+2*margin)*(math.ceil(
+    tile['height']/scale)+2*margin)
+
+    renderTime=costPerTile+renderedPixels*costPerPixel+\
+    featureCounts['features']*costPerFeature+\
+    featureCounts['vertices']*costPerVertex
+
+    renderMemory=memoryPerTile+renderedPixels*memoryPerPixel
+
+    return [renderTime, renderMemory]
+
+
+##############################################################################
+
+
+def predictRender(args, tiles, parallelJobs):
+    """
+    Predicts the wall time and peak memory of rendering tiles with their
+    predicted costs, scheduling the most expensive tiles first.
+
+    Args:
+        args: the parsed command line arguments        
+        tiles: the list of tiles with the predicted "cost" and "memory"
+        parallelJobs: the number of tiles rendered at the same time
+
+    Returns:
+        The predicted wall time in seconds and peak memory in bytes
+    """
+
+    slotTimes=[0.0]*max(1, parallelJobs)
+
+    # longest processing time first onto the earliest free slot
+    for tile in sorted(tiles, key=lambda t: t['cost'], reverse=True):
+        slotIndex=slotTimes.index(min(slotTimes))
+        slotTimes[slotIndex]+=tile['cost']
+
+    # worst case: the largest tiles render at the same time
+    peakMemory=sum(sorted((t['memory'] for t in tiles), 
+    reverse=True)[:len(slotTimes)])
+
+    return [max(slotTimes), peakMemory]
+
+
+##############################################################################
+
+
+def countGridFeatures(featureGrid, groupNames, i0, i1, j0, j1):
+    """
+    Sums up the feature counts of a range of grid cells.
+
+    Args:
+        featureGrid: the feature counts as returned by queryFeatureGrid()
+        groupNames: the names of the layer groups to be counted
+        i0: the first grid column
+        i1: the grid column after the last one
+        j0: the first grid row
+        j1: the grid row after the last one
+
+    Returns:
+        A dictionary with the "features" and "vertices" totals
+    """
+
+    featureCounts={'features': 0, 'vertices': 0}
+
+    for i in range(i0, i1):
+        for j in range(j0, j1):
+            for groupName in groupNames:
+                groupCounts=featureGrid.get((i, j), {}).get(groupName)
+                if groupCounts:
+                    featureCounts['features']+=groupCounts['features']
+                    featureCounts['vertices']+=groupCounts['vertices']
+
+    return featureCounts
+
+
+##############################################################################
+
+
+def partitionTiles(args, layout, featureGrid, cellSize):
+    """
+    Partitions the output image into a quadtree of tiles according to the 
+    feature density. With args.adaptive, tiles only covered by the base 
+    and water layers are rendered at a coarse resolution and empty tiles as 
+    a single pixel, to be upsampled when the tiles get assembled. With
+    args.balance, tiles are split until their predicted render time is
+    balanced, so sparse areas end up in few large tiles and dense areas in
+    many small ones.
+
+    Args:
+        args: the parsed command line arguments        
+        layout: dictionary with the "targetExtent", "imageWidth" and 
+                "imageHeight" of the output image
+        featureGrid: the feature counts as returned by queryFeatureGrid()
+        cellSize: the width and height of the grid cells in pixels
+
+    Returns:
+        The list of tiles as dictionaries with the pixel offsets "x" and "y",
+        the pixel dimensions "width" and "height", the downsampling factor 
+        "scale", and the predicted render time "cost" and memory "memory" of 
+        each tile
+    """
+
+    imageWidth=layout['imageWidth']
+    imageHeight=layout['imageHeight']
+    tiles=[]
+
+    def countFeatures(groupNames, i0, i1, j0, j1):
+        return countGridFeatures(featureGrid, groupNames, i0, i1, j0, j1)
+
+    def addTile(tile, i0, i1, j0, j1):
+        [tile['cost'], tile['memory']]=estimateTileCost(args, tile, 
+        countFeatures(['osm', 'base'], i0, i1, j0, j1))
+        tiles.append(tile)
+        return tile
+
+    # tiles more expensive than this get split when balancing, the fixed
+    # costs per tile do not shrink by splitting
+    gridColumns=math.ceil(imageWidth/cellSize)
+    gridRows=math.ceil(imageHeight/cellSize)
+    targetCost=(estimateTileCost(args, {'width': imageWidth, 'height': 
+    imageHeight}, countFeatures(['osm', 'base'], 0, gridColumns, 0, 
+    gridRows))[0]-costPerTile)/max(1, args.balance_tiles or 4*(args.max_jobs 
+    or 1))+costPerTile
+
+    def visitCell(i0, i1, j0, j1):
+        tile={'x': i0*cellSize, 'y': j0*cellSize}
+        tile['width']=min(i1*cellSize, imageWidth)-tile['x']
+        tile['height']=min(j1*cellSize, imageHeight)-tile['y']
+        tileSize=max(tile['width'], tile['height'])
+
+        # split into up to four quadrants
+        iSplits=[i0, (i0+i1)//2, i1] if i1-i0>1 else [i0, i1]
+        jSplits=[j0, (j0+j1)//2, j1] if j1-j0>1 else [j0, j1]
+        quadrants=[(iSplits[a], iSplits[a+1], jSplits[b], jSplits[b+1]) for 
+        a in range(len(iSplits)-1) for b in range(len(jSplits)-1)]
+
+        if args.adaptive and countFeatures(['osm'], i0, i1, j0, 
+        j1)['features']==0:
+            # base and water polygons only, or nothing at all
+            tile['scale']=args.coarse_factor
+            if countFeatures(['base'], i0, i1, j0, j1)['features']==0:
+                tile['scale']=tileSize
+
+            if math.ceil(tileSize/tile['scale'])<=args.tile_size:
+                addTile(tile, i0, i1, j0, j1)
+                return
+
+        tile['scale']=1
+
+        if len(quadrants)==1:
+            addTile(tile, i0, i1, j0, j1)
+            return
+
+        if tileSize<=args.tile_size:
+            if args.balance:
+                if addTile(tile, i0, i1, j0, j1)['cost']<=targetCost:
+                    return
+                tiles.pop()
+
+            # splitting further would not save any full-resolution pixels
+            elif not args.adaptive or all(countFeatures(['osm'], 
+            *quadrant)['features']>0 for quadrant in quadrants):
+                addTile(tile, i0, i1, j0, j1)
+                return
+
+        for quadrant in quadrants:
+            visitCell(*quadrant)
+
+    visitCell(0, gridColumns, 0, gridRows)
+
+    fullPixels=sum(t['width']*t['height'] for t in tiles if t['scale']==1)
+    print('Partitioning yields', len(tiles), 'tiles,', len([t for t in tiles 
+    if t['scale']==1]), 'at full resolution covering', 
+    f'{100*fullPixels/(imageWidth*imageHeight):.1f}', '% of the image, '
+    'predicted render times from', int(min(t['cost'] for t in tiles)), 'to', 
+    int(max(t['cost'] for t in tiles)), 'seconds')
+
+    return tiles
+
+
+##############################################################################
+
+
+def partitionOutput(args, layout, workDir, singleTile=False):
+    """
+    Partitions the output image into tiles, adaptively or balanced according 
+    to the feature density of the input GeoPackages if requested. The tiles
+    are ordered by decreasing predicted render time, so the most expensive
+    tiles get scheduled first. For a dry run, the predicted wall time and
+    peak memory of the render are printed for the tiles that would actually
+    be rendered without the dry run.
+
+    Args:
+        args: the parsed command line arguments        
+        layout: dictionary with the "targetExtent", "imageWidth" and 
+                "imageHeight" of the output image
+        workDir: the directory for temporary files
+        singleTile: the image is rendered as a whole unless partitioned 
+                    adaptively or balanced, e.g., by a local render
+
+    Returns:
+        The list of tiles as returned by partitionTiles(), without "cost" 
+        and "memory" if the feature density is unknown
+    """
+
+    tiles=None
+
+    if args.adaptive or args.balance or args.dry_run:
+        cellSize=min(args.adaptive_cell, args.tile_size)
+        featureGrid=queryFeatureGrid(args, layout, cellSize, {'osm': 
+        ['multipolygons', 'lines', 'points'], 'base': 
+        ['multipolygons_baselayer', 'multipolygons_water']}, workDir, 
+        countVertices=args.balance or args.dry_run)
+
+        if featureGrid is not None and (args.adaptive or args.balance):
+            tiles=partitionTiles(args, layout, featureGrid, cellSize)
+        elif featureGrid is not None:
+            # dry run of the uniform tiles or the single image
+            tiles=[dict(tile, scale=1) for tile in splitIntoTiles(
+            layout['imageWidth'], layout['imageHeight'], args.tile_size)]
+            if singleTile:
+                tiles=[{'x': 0, 'y': 0, 'width': layout['imageWidth'], 
+                'height': layout['imageHeight'], 'scale': 1, 'margin': 0}]
+
+            for tile in tiles:
+                [tile['cost'], tile['memory']]=estimateTileCost(args, tile, 
+                countGridFeatures(featureGrid, ['osm', 'base'], tile['x']//
+                cellSize, math.ceil((tile['x']+tile['width'])/cellSize), 
+                tile['y']//cellSize, math.ceil((tile['y']+tile['height'])/
+                cellSize)))
+        else:
+            print('Cannot count features, falling back to uniform tiles')
+
+            if args.dry_run:
+                print('Cannot predict the render time and memory without '
+                'feature counts')
+
+    if tiles is None:
+        return [dict(tile, scale=1) for tile in splitIntoTiles(
+        layout['imageWidth'], layout['imageHeight'], args.tile_size)]
+
+    tiles.sort(key=lambda t: t['cost'], reverse=True)
+
+    if args.dry_run:
+        parallelJobs=min(max(1, args.max_jobs or 1), len(tiles))
+        [wallTime, peakMemory]=predictRender(args, tiles, parallelJobs)
+
+        print('Predicted render time of', len(tiles), 'tiles:', 
+        int(sum(t['cost'] for t in tiles)), 'seconds in total,', 
+        int(wallTime), 'seconds wall time with', parallelJobs, 
+        'parallel jobs')
+        print('Predicted peak memory:', f'{peakMemory/(1<<30):.1f}', 'GiB')
+
+    return tiles
+
+
+##############################################################################
+
+
+def renderTile(args, layout, tile, outImage, styleSheet, margin, 
+outputPrefix=''):
+    """
+    Renders a single tile of the output image, downsampled by its scale.
+
+    Args:
+        args: the parsed command line arguments        
+        layout: dictionary with the "targetExtent", "imageWidth" and 
+                "imageHeight" of the output image
+        tile: the tile as a dictionary with pixel offsets, dimensions and
+              scale
+        outImage: the georeferenced tile image to be written
+        styleSheet: the path to the style sheet to be rendered
+        margin: the pixels rendered beyond the tile boundaries
+        outputPrefix: text put in front of each line of the tool output
+    """
+
+    [tileMinX, tileMinY, tileMaxX, tileMaxY]=computeTileExtent(layout, tile)
+    scale=tile.get('scale', 1)
+
+    # coarse tiles only contain polygons and do not need a margin
+    renderLULC(args, math.ceil(tile['width']/scale), math.ceil(
+    tile['height']/scale), tileMinX, tileMinY, tileMaxX, tileMaxY, 
+    outImage=outImage, styleSheet=styleSheet, margin=margin if scale==1 else 
+    0, outputPrefix=outputPrefix)
+
+
+##############################################################################
+
+
+def renderTilesLocally(args, layout, tiles, styleSheet, workDir):
+    """
+    Renders the tiles of the output image concurrently on this machine and
+    assembles them into the output image.
+
+    Args:
+        args: the parsed command line arguments        
+        layout: dictionary with the "targetExtent", "imageWidth" and 
+                "imageHeight" of the output image
+        tiles: the list of tiles
+        styleSheet: the path to the style sheet to be rendered
+        workDir: the directory to write the tile images to
+    """
+
+    def renderIndexedTile(tileIndex):
+        tileImage=os.path.join(workDir, f'tile_{tileIndex:06d}.tif')
+        renderTile(args, layout, tiles[tileIndex], tileImage, styleSheet, 
+        args.tile_margin, f'[{tileIndex:06d}] ')
+        return tileImage
+
+    print('Rendering', len(tiles), 'tiles')
+    renderStartTime=time.time()
+
+    with ThreadPoolExecutor(max_workers=max(1, args.max_jobs or 1)) as \
+    executor:
+        tileImages=list(executor.map(renderIndexedTile, range(len(tiles))))
+
+    print('Rendered', len(tiles), 'tiles in', int(time.time()-
+    renderStartTime), 'seconds')
+
+    mosaicTiles(args, layout, tileImages, workDir)
+
+
+##############################################################################
+
+
+def mosaicTiles(args, layout, tileImages, workDir):
+    """
+    Assembles georeferenced tile images into the output image, resampling
+    downsampled tiles to the output resolution.
+
+    Args:
+        args: the parsed command line arguments        
+        layout: dictionary with the "targetExtent", "imageWidth" and 
+                "imageHeight" of the output image
+        tileImages: the list of tile images
+        workDir: the directory to write the mosaic VRT to
+    """
+
+    [targetMinX, targetMinY, targetMaxX, targetMaxY]=layout['targetExtent']
+
+    # file list avoids command line length limits
+    tileListFile=os.path.join(workDir, 'tiles.txt')
+    with open(tileListFile, 'w') as target:
+        for tileImage in tileImages:
+            target.write(os.path.abspath(tileImage)+'\n')
+
+    mosaicVrt=os.path.join(workDir, 'mosaic.vrt')
+    print('Assembling', len(tileImages), 'tiles into', args.outImage)
+
+    # fixed output grid, tiles of lower resolution are upsampled
+    toolResult=runExecutable(['gdalbuildvrt', '-te', str(targetMinX), 
+    str(targetMinY), str(targetMaxX), str(targetMaxY), '-tr', 
+    repr((targetMaxX-targetMinX)/layout['imageWidth']), 
+    repr((targetMaxY-targetMinY)/layout['imageHeight']), '-r', 'nearest', 
+    '-input_file_list', tileListFile, mosaicVrt], printCmdLine=True, 
+    streamOutput=True, timeout=args.tool_timeout, tempFiles=[mosaicVrt])
+
+    if toolResult.exitCode!=0:
+        raise RenderError('gdalbuildvrt exited abnormally with code '+
+        str(toolResult.exitCode), 5)
+
+    gdalCmdline=['gdal_translate', mosaicVrt, args.outImage]
+    if args.outImage.lower().endswith(('.tif', '.tiff')):
+        gdalCmdline[1:1]=['-co', 'BIGTIFF=IF_SAFER', '-co', 'TILED=YES']
+
+    toolResult=runExecutable(gdalCmdline, printCmdLine=True, 
+    streamOutput=True, timeout=args.tool_timeout, tempFiles=[args.outImage])
+
+    if toolResult.exitCode!=0:
+        raise RenderError('gdal_translate exited abnormally with code '+
+        str(toolResult.exitCode), 5)
+
+    print('Assembled', args.outImage)
+
+
+##############################################################################
+
+
+def createTileQueue(args, imageWidth, imageHeight, mapnikGsd, targetMinX, 
+targetMinY, targetMaxX, targetMaxY):
+    """
+    Coordinator: writes the tile jobs of the render into the queue directory
+    for workers on any number of nodes to pick up. An existing queue for the 
+    same render is kept, so completed tiles are not rendered again.
+
+    Args:
+        args: the parsed command line arguments        
+        imageWidth: the width of the output image in pixels
+        imageHeight: the height of the output image in pixels
+        mapnikGsd: the (unscaled) Mapnik GSD in pixels per meter
+        targetMinX: the minimum horizontal coordinate of the extent
+        targetMinY: the minimum vertical coordinate of the extent
+        targetMaxX: the maximum horizontal coordinate of the extent
+        targetMaxY: the maximum vertical coordinate of the extent
+    """
+
+    queueInfo={'extent': [args.lonMin, args.latMin, args.lonMax, 
+    args.latMax], 'gsd': args.gsd, 'imageWidth': imageWidth, 'imageHeight': 
+    imageHeight, 'mapnikGsd': mapnikGsd, 'targetExtent': [targetMinX, 
+    targetMinY, targetMaxX, targetMaxY], 'tileSize': args.tile_size, 
+    'tileMargin': args.tile_margin, 'leaseTime': args.lease_time, 
+    'maxAttempts': args.max_attempts, 'adaptive': args.adaptive, 'balance': 
+    args.balance}
+
+    queueInfoFile=os.path.join(args.queue_dir, 'queue.json')
+
+    if os.path.exists(queueInfoFile) and not args.dry_run:
+        if readJsonFile(queueInfoFile)!=queueInfo:
+            raise RenderError('Queue '+args.queue_dir+' already holds a '
+            'different render, please use an empty queue directory', 5)
+
+        print('Queue', args.queue_dir, 'already exists,', countDoneTiles(
+        args.queue_dir), 'of', 
+        len(os.listdir(os.path.join(args.queue_dir, 'jobs'))), 
+        'tiles are done')
+        return
+
+    workDir=tempfile.mkdtemp(prefix='lulc_')
+
+    try:
+        # tiles depend on the features in the input GeoPackages
+        if args.adaptive or args.balance or args.dry_run:
+            prepareDatasource(args, queueInfo['extent'], workDir, 
+            queryOnly=True)
+
+        tiles=partitionOutput(args, queueInfo, workDir)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.dry_run:
+        return
+
+    for subDir in ['jobs', 'leases', 'done', 'failed']:
+        os.makedirs(os.path.join(args.queue_dir, subDir), exist_ok=True)
+
+    # workers process the jobs in the order of their IDs, i.e., the most
+    # expensive ones first
+    for tileIndex, tile in enumerate(tiles):
+        tile['id']=f'{tileIndex:06d}'
+        writeJsonFile(os.path.join(args.queue_dir, 'jobs', tile['id']+
+        '.json'), tile)
+
+    # written last, marks the queue as complete
+    writeJsonFile(queueInfoFile, queueInfo)
+
+    print('Queued', len(tiles), 'tiles of at most', args.tile_size, 'x', 
+    args.tile_size, 'rendered pixels in', args.queue_dir)
+
+
+##############################################################################
+
+
+def readLeaseOwner(leaseFile):
+    """
+    Reads the ID of the worker holding a lease.
+
+    Args:
+        leaseFile: the path to the lease file
+
+    Returns:
+        The worker ID as a string, None if there is no lease
+    """
+
+    try:
+        with open(leaseFile) as source:
+            return source.read().strip()
+    except OSError:
+        return None
+
+
+##############################################################################
+
+
+def createLease(leaseFile, workerId):
+    """
+    Creates a lease file exclusively and writes the worker ID into it.
+
+    Args:
+        leaseFile: the path to the lease file
+        workerId: the unique ID of the worker holding the lease
+
+    Returns:
+        True if the lease file has been created
+    """
+
+    try:
+        leaseFd=os.open(leaseFile, os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(leaseFd, 'w') as target:
+        target.write(workerId)
+
+    return True
+
+
+##############################################################################
+
+
+def releaseLease(leaseFile, workerId):
+    """
+    Removes a lease file unless it has been broken and taken over by another
+    worker in the meantime.
+
+    Args:
+        leaseFile: the path to the lease file
+        workerId: the unique ID of the worker holding the lease
+    """
+
+    if readLeaseOwner(leaseFile)==workerId:
+        removeFiles([leaseFile])
+
+
+##############################################################################
+
+
+def fileSystemTime(directory, workerId):
+    """
+    Determines the current time of the file system holding the queue, so
+    lease ages do not depend on the clocks of the nodes agreeing.
+
+    Args:
+        directory: a directory on the file system
+        workerId: the unique ID of the worker, to name the probe file
+
+    Returns:
+        The modification time of a freshly written probe file in seconds
+    """
+
+    probeFile=os.path.join(directory, '.probe.'+workerId)
+
+    with open(probeFile, 'w') as target:
+        target.write(workerId)
+
+    try:
+        return os.stat(probeFile).st_mtime
+    finally:
+        removeFiles([probeFile])
+
+
+##############################################################################
+
+
+def claimTile(queueDir, tileId, workerId, leaseTime, fileSystemNow):
+    """
+    Tries to claim a tile by creating its lease file exclusively. Leases 
+    that have not been renewed within the lease time are considered to
+    belong to a crashed worker and get broken. Lease ages are measured by
+    the clock of the file system holding the queue.
+
+    Args:
+        queueDir: the queue directory
+        tileId: the ID of the tile job
+        workerId: the unique ID of the claiming worker
+        leaseTime: the lease time in seconds
+        fileSystemNow: the current time of the file system holding the queue,
+        read once per poll by fileSystemTime()
+
+    Returns:
+        True if the tile has been claimed by the worker
+    """
+
+    leaseDir=os.path.join(queueDir, 'leases')
+    leaseFile=os.path.join(leaseDir, tileId+'.lease')
+
+    if createLease(leaseFile, workerId):
+        return True
+
+    try:
+        leaseOwner=readLeaseOwner(leaseFile)
+        leaseMtime=os.stat(leaseFile).st_mtime
+
+        if fileSystemNow-leaseMtime<leaseTime:
+            return False
+
+        # rename first so only one worker breaks the expired lease
+        expiredFile=leaseFile+'.'+workerId+'.expired'
+        os.rename(leaseFile, expiredFile)
+    except OSError:
+        return False
+
+    #
+    # another worker may have broken the lease and claimed the tile between
+    # the check and the rename, the moved lease is restored then
+    #
+    try:
+        expiredMtime=os.stat(expiredFile).st_mtime
+    except OSError:
+        return False
+
+    expiredOwner=readLeaseOwner(expiredFile)
+    removeFiles([expiredFile])
+
+    if expiredMtime!=leaseMtime or expiredOwner!=leaseOwner:
+        createLease(leaseFile, expiredOwner or '')
+        return False
+
+    print('Lease of tile', tileId, 'held by', leaseOwner, 'expired, '
+    'retrying')
+
+    return createLease(leaseFile, workerId)
+
+
+##############################################################################
+
+
+def renderQueuedTile(args, queueInfo, styleSheet, tileId, workerId):
+    """
+    Worker: renders a claimed tile into the "done" directory of the queue
+    while renewing its lease periodically.
+
+    Args:
+        args: the parsed command line arguments        
+        queueInfo: the tile queue description
+        styleSheet: the path to the style sheet to be rendered
+        tileId: the ID of the claimed tile job
+        workerId: the unique ID of the worker
+
+    Returns:
+        True if the tile has been rendered successfully
+    """
+
+    tile=readJsonFile(os.path.join(args.queue_dir, 'jobs', tileId+'.json'))
+
+    leaseFile=os.path.join(args.queue_dir, 'leases', tileId+'.lease')
+    tileImage=os.path.join(args.queue_dir, 'done', tileId+'.tif')
+    partialImage=os.path.join(args.queue_dir, 'done', tileId+'.'+workerId+
+    '.partial.tif')
+
+    # renew lease while rendering, as long as no other worker broke it
+    leaseDone=threading.Event()
+
+    def renewLease():
+        while not leaseDone.wait(queueInfo['leaseTime']/4):
+            leaseOwner=readLeaseOwner(leaseFile)
+
+            if leaseOwner is None and createLease(leaseFile, workerId):
+                continue
+
+            if leaseOwner!=workerId:
+                print('Worker', workerId, 'lost the lease of tile', tileId,
+                'to', leaseOwner or 'another worker')
+                return
+
+            try:
+                os.utime(leaseFile)
+            except OSError:
+                pass
+
+    leaseThread=threading.Thread(target=renewLease, daemon=True)
+    leaseThread.start()
+
+    print('Worker', workerId, 'rendering tile', tileId, 'at pixel offset', 
+    tile['x'], tile['y'], 'with', tile['width'], 'x', tile['height'], 
+    'pixels', 'downsampled by '+str(tile['scale']) if tile.get('scale', 1)>1
+    else '')
+
+    try:
+        renderTile(args, queueInfo, tile, partialImage, styleSheet, 
+        queueInfo['tileMargin'], '['+tileId+'] ')
+        os.replace(partialImage, tileImage)
+        success=True
+    except RenderError as exc:
+        print('Worker', workerId, 'failed to render tile', tileId+':', exc)
+        removeFiles([partialImage, partialImage+'.png'])
+        writeJsonFile(os.path.join(args.queue_dir, 'failed', tileId+'.'+
+        workerId+'.json'), {'worker': workerId, 'time': time.time()})
+        success=False
+    finally:
+        leaseDone.set()
+        leaseThread.join()
+        releaseLease(leaseFile, workerId)
+
+    return success
+
+
+##############################################################################
+
+
+def runTileWorker(args):
+    """
+    Worker: claims, renders and completes tiles from the queue until all 
+    tiles are done or have failed too often. Several tiles are rendered
+    concurrently according to the job limit.
+
+    Args:
+        args: the parsed command line arguments        
+    """
+
+    queueInfoFile=os.path.join(args.queue_dir, 'queue.json')
+
+    # wait for the coordinator
+    while not os.path.exists(queueInfoFile):
+        print('Waiting for tile queue', args.queue_dir)
+        time.sleep(args.poll_interval)
+
+    queueInfo=readJsonFile(queueInfoFile)
+
+    if [args.lonMin, args.latMin, args.lonMax, args.latMax, args.gsd]!=\
+    queueInfo['extent']+[queueInfo['gsd']]:
+        print('Warning: extent and GSD on the command line differ from the '
+        'queued render, rendering the queue as-is')
+
+    # private style sheet copy, other workers may use another data source
+    styleDir=tempfile.mkdtemp(prefix='lulc_style_')
+
+    jobDir=os.path.join(args.queue_dir, 'jobs')
+    doneDir=os.path.join(args.queue_dir, 'done')
+    failedDir=os.path.join(args.queue_dir, 'failed')
+    workerBaseId=socket.gethostname()+'_'+str(os.getpid())
+
+    def workerLoop(slot):
+        workerId=workerBaseId+'_'+str(slot)
+        renderedCount=0
+
+        while True:
+            tileIds=sorted(f[:-5] for f in os.listdir(jobDir) if 
+            f.endswith('.json'))
+            failedIds=[f.split('.')[0] for f in os.listdir(failedDir)]
+
+            openIds=[tileId for tileId in tileIds if not os.path.exists(
+            os.path.join(doneDir, tileId+'.tif')) and failedIds.count(tileId)<
+            queueInfo['maxAttempts']]
+
+            if not openIds:
+                return renderedCount
+
+            # a single probe of the file system clock serves the whole poll
+            fileSystemNow=fileSystemTime(os.path.join(args.queue_dir, 
+            'leases'), workerId)
+            claimedId=next((tileId for tileId in openIds if claimTile(
+            args.queue_dir, tileId, workerId, queueInfo['leaseTime'], 
+            fileSystemNow)), None)
+
+            # remaining tiles are being rendered by other workers, wait for
+            # them to finish or their leases to expire
+            if claimedId is None:
+                time.sleep(args.poll_interval)
+                continue
+
+            # the tile may have been completed right before claiming it
+            if os.path.exists(os.path.join(doneDir, claimedId+'.tif')):
+                releaseLease(os.path.join(args.queue_dir, 'leases', claimedId+
+                '.lease'), workerId)
+                continue
+
+            if renderQueuedTile(args, queueInfo, styleSheet, claimedId, 
+            workerId):
+                renderedCount+=1
+
+            print('Worker', workerId, 'finished tile', claimedId+',', 
+            countDoneTiles(args.queue_dir), 'of', len(tileIds), 'tiles in '
+            'queue done')
+
+    try:
+        prepareDatasource(args, queueInfo['extent'], styleDir)
+
+        styleSheet=args.mapnik_style_sheet
+        if not args.no_templates:
+            styleSheet=modifyXmlTemplates(args, queueInfo['mapnikGsd'], 
+            styleDir)
+
+        with ThreadPoolExecutor(max_workers=max(1, args.max_jobs or 1)) as \
+        executor:
+            renderedCount=sum(executor.map(workerLoop, range(max(1, 
+            args.max_jobs or 1))))
+    finally:
+        shutil.rmtree(styleDir, ignore_errors=True)
+
+    print('Worker', workerBaseId, 'rendered', renderedCount, 'tiles, no '
+    'open tiles left in queue')
+
+
+##############################################################################
+
+
+def assembleTiles(args):
+    """
+    Assembles the rendered tiles of the queue into the georeferenced output 
+    image.
+
+    Args:
+        args: the parsed command line arguments        
+    """
+
+    jobDir=os.path.join(args.queue_dir, 'jobs')
+    doneDir=os.path.join(args.queue_dir, 'done')
+
+    tileIds=sorted(f[:-5] for f in os.listdir(jobDir) if f.endswith('.json'))
+    missingIds=[tileId for tileId in tileIds if not os.path.exists(
+    os.path.join(doneDir, tileId+'.tif'))]
+
+    if missingIds:
+        raise RenderError(str(len(missingIds))+' of '+str(len(tileIds))+
+        ' tiles have not been rendered yet or failed, e.g. '+', '.join(
+        missingIds[:10]), 5)
+
+    queueInfo=readJsonFile(os.path.join(args.queue_dir, 'queue.json'))
+
+    mosaicTiles(args, queueInfo, [os.path.join(doneDir, tileId+'.tif') for 
+    tileId in tileIds], args.queue_dir)
+
+
+##############################################################################
+
+
+def readEnviHeader(headerFile):
+    """
+    Reads the raster layout from the header of an ENVI raw image.
+
+    Args:
+        headerFile: the path to the ENVI header (.hdr)
+
+    Returns:
+        A dictionary with the lowercase header keys and their values as
+        strings
+    """
+
+    header={}
+
+    with open(headerFile, 'r') as source:
+        for line in source:
+            if '=' in line:
+                key, value=line.split('=', 1)
+                header[key.strip().lower()]=value.strip()
+
+    return header
+
+
+##############################################################################
+
+
+def renderArray(lonMin, latMin, lonMax, latMax, gsd, gpkgFiles, 
+styleSheet='lulc_corine.xml', verbose=False, **options):
+    """
+    Python API: renders a LULC image in-process and returns it as a NumPy 
+    array instead of writing a GeoTIFF. Errors are raised as RenderError 
+    rather than terminating the interpreter, invalid arguments as 
+    ValueError. The image is memory-mapped 
+    from the uncompressed raw output of the render where the OS permits 
+    removing mapped files, and read into memory otherwise.
+
+    Args:
+        lonMin: the minimum longitude of the scene in degrees
+        latMin: the minimum latitude of the scene in degrees
+        lonMax: the maximum longitude of the scene in degrees
+        latMax: the maximum latitude of the scene in degrees
+        gsd: the ground sampling distance in meters
+        gpkgFiles: the path to the GeoPackage, or a list of GeoPackages 
+                   and directories containing them
+        styleSheet: the path to the Mapnik style sheet to be rendered
+        verbose: echo the output of mapnik-render and gdal_translate to the
+                 console, otherwise it is only printed on failure
+        options: further command line options by their argument names, 
+                 e.g., cache_dir='/data/cache' or mapnik_plugins='...'
+
+    Returns:
+        The image as a read-only uint8 NumPy array of shape (height, width,
+        bands), and its GDAL-style geotransform in EPSG:3857 coordinates
+    """
+
+    # needs 'pip install numpy', for the Python API only
+    import numpy
+
+    if isinstance(gpkgFiles, str):
+        gpkgFiles=[gpkgFiles]
+
+    # argparse would exit the interpreter on invalid arguments
+    try:
+        sceneValues=[float(value) for value in [lonMin, latMin, lonMax, 
+        latMax, gsd]]
+    except (TypeError, ValueError):
+        raise ValueError('renderArray() expects numbers for the extent and '
+        'GSD') from None
+
+    gpkgFiles=[str(gpkgFile) for gpkgFile in gpkgFiles or []]
+    if not gpkgFiles:
+        raise ValueError('renderArray() expects at least one GeoPackage')
+
+    # command line defaults for everything not given
+    try:
+        args=parseCmdLine(['--mapnik-style-sheet', styleSheet, '--']+
+        [repr(value) for value in sceneValues]+gpkgFiles+['lulc.img'])
+    except SystemExit:
+        raise ValueError('Invalid arguments for renderArray()') from None
+
+    for optionName, optionValue in options.items():
+        if not hasattr(args, optionName):
+            raise TypeError('renderArray() got an unknown option '+
+            optionName)
+        setattr(args, optionName, optionValue)
+
+    # once per process, the tools do not change; the check auto-detects
+    # the plugin directory, which every later call needs as well
+    toolchainKey=(args.mapnik_render, args.mapnik_plugins)
+    if toolchainKey not in checkedToolchains:
+        checkToolchain(args)
+        checkedToolchains[toolchainKey]=args.mapnik_plugins
+    args.mapnik_plugins=checkedToolchains[toolchainKey]
+
+    [imageWidth, imageHeight, mapnikGsd, targetMinX, targetMinY, targetMaxX, 
+    targetMaxY]=computeOutputDimensions(args)
+
+    # private work directory, so concurrent renders do not interfere
+    workDir=tempfile.mkdtemp(prefix='lulc_')
+
+    try:
+        prepareDatasource(args, [args.lonMin, args.latMin, args.lonMax, 
+        args.latMax], workDir)
+
+        if not args.no_templates:
+            styleSheet=modifyXmlTemplates(args, mapnikGsd, workDir)
+
+        # pixel-interleaved raw image, can be mapped as-is
+        rawImage=os.path.join(workDir, 'lulc.img')
+        renderLULC(args, imageWidth, imageHeight, targetMinX, targetMinY, 
+        targetMaxX, targetMaxY, outImage=rawImage, styleSheet=styleSheet, 
+        translateOptions=['-of', 'ENVI', '-co', 'INTERLEAVE=BIP'], 
+        streamOutput=verbose)
+
+        header=readEnviHeader(os.path.splitext(rawImage)[0]+'.hdr')
+
+        try:
+            shape=(int(header['lines']), int(header['samples']), 
+            int(header['bands']))
+        except (KeyError, ValueError):
+            raise RenderError('Cannot read the layout of the rendered image '
+            +rawImage, 4) from None
+
+        if header.get('data type', '1')!='1' or \
+        header.get('interleave', 'bip').lower()!='bip':
+            raise RenderError('Unexpected data type or interleave of the '
+            'rendered image '+rawImage, 4)
+
+        image=numpy.memmap(rawImage, dtype=numpy.uint8, mode='r', offset=int(
+        header.get('header offset', '0')), shape=shape)
+
+        # Windows cannot remove mapped files
+        if os.name=='nt':
+            image=numpy.array(image)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    geoTransform=(targetMinX, (targetMaxX-targetMinX)/imageWidth, 0.0, 
+    targetMaxY, 0.0, -(targetMaxY-targetMinY)/imageHeight)
+
+    return image, geoTransform
+
+
+##############################################################################
+
+
+def renderScene(args):
+    """
+    Controls the render workflow on a high level according to the command
+    line arguments.
+
+    Args:
+        args: the parsed command line arguments        
+    """
+
+    # check for working toolchain
+    checkToolchain(args)
+
+    # distributed rendering, tiles come from the queue
+    if args.role=='assemble':
+        assembleTiles(args)
+        return
+
+    if args.role=='worker':
+        runTileWorker(args)
+        return
+
+    # compute output image dimensions
+    [imageWidth, imageHeight, mapnikGsd, targetMinX, targetMinY, targetMaxX, 
+    targetMaxY]=computeOutputDimensions(args)
+
+    if args.role=='coordinator':
+        createTileQueue(args, imageWidth, imageHeight, mapnikGsd, targetMinX, 
+        targetMinY, targetMaxX, targetMaxY)
+        return
+
+    workDir=tempfile.mkdtemp(prefix='lulc_')
+
+    try:
+        # select, combine and cache input GeoPackages
+        prepareDatasource(args, [args.lonMin, args.latMin, args.lonMax, 
+        args.latMax], workDir, queryOnly=args.dry_run)
+
+        # modify XML entities in the default templates
+        if not args.no_templates and not args.dry_run:
+            modifyXmlTemplates(args, mapnikGsd)
+
+        # render!
+        if args.adaptive or args.balance or args.dry_run:
+            layout={'targetExtent': [targetMinX, targetMinY, targetMaxX, 
+            targetMaxY], 'imageWidth': imageWidth, 'imageHeight': imageHeight}
+            tiles=partitionOutput(args, layout, workDir, singleTile=True)
+
+            if not args.dry_run:
+                renderTilesLocally(args, layout, tiles, 
+                args.mapnik_style_sheet, workDir)
+        else:
+            renderLULC(args, imageWidth, imageHeight, targetMinX, targetMinY, 
+            targetMaxX, targetMaxY)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+
+##############################################################################
+
+
+def main(args):
+    """
+    The entry point controls the render workflow on a high level.
+
+    Args:
+        args: the parsed command line arguments        
+    """
+
+    try:
+        renderScene(args)
+    except RenderError as exc:
+        print(exc)
+        sys.exit(exc.exitCode)
 
 
 ##############################################################################
@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+
+#
+# Orchestration of the external command line tools (ogr2ogr, ogrinfo,
+# mapnik-render, gdal_translate etc.) shared by the LULC scripts. Tool
+# output is streamed line by line, independent tools may run concurrently
+# under a configurable limit, and tools exceeding their timeout get
+# cancelled cleanly including the removal of their partial outputs.
+#
+# Written in Python - not pretty, but functional.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import atexit
+import codecs
+import locale
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+
+# number of trailing output lines kept for streamed tools
+streamTailLines=200
+
+# seconds to wait for a terminated tool before killing it
+terminateGracePeriod=5
+
+# tools run in their own process group, so a timeout or cancellation reaches
+# the processes they spawn as well
+if sys.platform=='win32':
+    processGroupOptions={'creationflags':
+    subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    processGroupOptions={'start_new_session': True}
+
+# the tools currently running in any thread, their process groups do not
+# receive the Ctrl-C of the terminal
+runningProcesses=set()
+
+
+##############################################################################
+
+
+class FailFastError(Exception):
+    """
+    Raised by a job of runExecutablesAsync() to cancel the remaining jobs
+    when running with failFast.
+    """
+
+
+##############################################################################
+
+
+def outputEncoding():
+    """
+    Returns the encoding of the tool output, i.e., the OS device codepage
+    of the console or the preferred locale encoding if there is no console.
+
+    Returns:
+        The name of the encoding as a string
+    """
+
+    # we need this to get the console output formatted correctly
+    return os.device_encoding(1) or locale.getpreferredencoding(False)
+
+
+##############################################################################
+
+
+def runSynchronously(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code. If the caller
+    already runs an event loop (e.g., inside a notebook), the coroutine is
+    executed by a separate thread with its own loop.
+
+    Args:
+        coroutine: the coroutine to be run
+
+    Returns:
+        The result of the coroutine
+    """
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result=[]
+    error=[]
+
+    def runThread():
+        try:
+            result.append(asyncio.run(coroutine))
+        except BaseException as exc:
+            error.append(exc)
+
+    thread=threading.Thread(target=runThread)
+    thread.start()
+    thread.join()
+
+    if error:
+        raise error[0]
+
+    return result[0]
+
+
+##############################################################################
+
+
+def removeFiles(fileNames):
+    """
+    Removes files silently, e.g., the partial outputs of cancelled tools.
+
+    Args:
+        fileNames: the list of file names to be removed, may be None
+    """
+
+    for fileName in fileNames or []:
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+
+##############################################################################
+
+
+def signalProcessGroup(process, kill=False):
+    """
+    Sends a termination or kill signal to a tool and all processes in its
+    process group, e.g., the children of a shell wrapper.
+
+    Args:
+        process: the asyncio process object of the tool
+        kill: kill rather than terminate the processes
+    """
+
+    try:
+        if sys.platform=='win32':
+            if kill:
+                process.kill()
+            else:
+                process.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            os.killpg(process.pid, signal.SIGKILL if kill else 
+            signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+##############################################################################
+
+
+async def terminateProcess(process):
+    """
+    Terminates a running tool including the processes it spawned, and kills
+    them if the tool does not exit within the grace period. The output pipe
+    gets closed, so processes which left the process group cannot keep the
+    reader waiting.
+
+    Args:
+        process: the asyncio process object of the tool
+    """
+
+    if process.returncode is None:
+        signalProcessGroup(process)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(process.wait()), 
+            terminateGracePeriod)
+        except asyncio.TimeoutError:
+            signalProcessGroup(process, kill=True)
+    else:
+        # the tool is gone, but its children may still be running
+        signalProcessGroup(process, kill=True)
+
+    # asyncio only reports the exit once all pipes are closed
+    transport=getattr(process, '_transport', None)
+    if transport:
+        transport.close()
+
+    await process.wait()
+
+
+##############################################################################
+
+
+def terminateRunningProcesses(kill=False):
+    """
+    Signals the process groups of all running tools, including the ones
+    awaited by other threads, which are not cancelled by an interrupt of 
+    the main thread.
+
+    Args:
+        kill: kill rather than terminate the processes
+    """
+
+    # copied in one step, other threads may add or remove processes
+    for process in list(runningProcesses):
+        signalProcessGroup(process, kill)
+
+
+##############################################################################
+
+
+def interruptHandler(signalNumber, frame):
+    """
+    Handles Ctrl-C by passing it on to the running tools before raising
+    KeyboardInterrupt in the main thread as usual. The tools of worker
+    threads then fail, so the threads clean up their partial outputs.
+
+    Args:
+        signalNumber: the number of the received signal
+        frame: the interrupted stack frame
+    """
+
+    terminateRunningProcesses()
+    signal.default_int_handler(signalNumber, frame)
+
+
+# only if nobody else, e.g., a notebook kernel, handles Ctrl-C already
+if threading.current_thread() is threading.main_thread() and \
+signal.getsignal(signal.SIGINT) is signal.default_int_handler:
+    signal.signal(signal.SIGINT, interruptHandler)
+
+# tools still running when the interpreter exits would be orphaned
+atexit.register(terminateRunningProcesses, kill=True)
+
+
+##############################################################################
+
+
+async def runExecutableAsync(args, stdinStr='', printCmdLine=False,
+streamOutput=False, timeout=None, tempFiles=None, outputPrefix='',
+lineCallback=None):
+    """
+    Runs program with parameters asynchronously and returns the exit code
+    and output. The merged stdout/err output is read while the program is
+    running and can be echoed to the console immediately.
+
+    Args:
+        args: the program name and arguments as a string list
+        stdinStr: the string to be used as stdin input (you may have to add
+                  a newline to terminate)
+        printCmdLine: print the command line before running the program
+        streamOutput: echo the program output to the console while it is
+                      running; only the last lines of the output will be
+                      kept in the result then
+        timeout: the maximum runtime in seconds, None for no limit
+        tempFiles: list of files to be removed when the program fails,
+                   times out or gets cancelled, e.g., its partial outputs
+        outputPrefix: text put in front of each streamed output line, the
+                      output is written line by line rather than as it
+                      comes in if set to tell concurrent tools apart
+        lineCallback: function called with each complete output line
+                      (without line break) as it comes in, may be None
+
+    Returns:
+        A SimpleNamespace with the members "exitCode" and "output" for
+        the exit code and merged stdout/err output text respectively encoded
+        using the OS device codepage, "timedOut" if the program got
+        terminated due to the timeout, and "runtime" for the wall time in
+        seconds. The exit code is None if the program did not finish.
+    """
+
+    if printCmdLine:
+        if stdinStr:
+            print('echo', stdinStr, '|', ' '.join(args))
+        else:
+            print(' '.join(args))
+
+    startTime=time.time()
+
+    try:
+        process=await asyncio.create_subprocess_exec(*args,
+        stdin=asyncio.subprocess.PIPE if stdinStr else asyncio.subprocess.\
+        DEVNULL, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT, **processGroupOptions)
+    except OSError as exc:
+        # program does not exist or cannot be executed
+        removeFiles(tempFiles)
+        return SimpleNamespace(exitCode=127, output=str(exc), timedOut=False,
+        runtime=0)
+
+    runningProcesses.add(process)
+
+    decoder=codecs.getincrementaldecoder(outputEncoding())(errors='replace')
+    outputLines=deque(maxlen=streamTailLines if streamOutput else None)
+    pending=''
+
+    def consume(text, final=False):
+        nonlocal pending
+
+        if streamOutput and not outputPrefix:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        pending+=text
+        lines=pending.splitlines(keepends=True)
+
+        # keep incomplete last line for the next chunk
+        pending=''
+        if lines and not final and not lines[-1].endswith(('\n', '\r')):
+            pending=lines.pop()
+
+        for line in lines:
+            outputLines.append(line)
+
+            if streamOutput and outputPrefix:
+                print(outputPrefix+line.rstrip('\r\n'), flush=True)
+
+            if lineCallback:
+                lineCallback(line.rstrip('\r\n'))
+
+    async def communicate():
+        if stdinStr:
+            process.stdin.write(stdinStr.encode(outputEncoding()))
+            await process.stdin.drain()
+            process.stdin.close()
+
+        # read in chunks rather than lines since progress indicators like
+        # the one of ogr2ogr do not terminate their lines
+        while True:
+            chunk=await process.stdout.read(65536)
+            if not chunk:
+                break
+            consume(decoder.decode(chunk))
+
+        consume(decoder.decode(b'', final=True), final=True)
+        return await process.wait()
+
+    try:
+        exitCode=await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        await terminateProcess(process)
+        removeFiles(tempFiles)
+        outputLines.append('\nTerminated after exceeding the timeout of '+
+        str(timeout)+' seconds\n')
+        return SimpleNamespace(exitCode=None, output=''.join(outputLines),
+        timedOut=True, runtime=time.time()-startTime)
+    except BaseException:
+        # cancellation, keyboard interrupt
+        await asyncio.shield(terminateProcess(process))
+        removeFiles(tempFiles)
+        raise
+    finally:
+        runningProcesses.discard(process)
+
+    if exitCode!=0:
+        removeFiles(tempFiles)
+
+    return SimpleNamespace(exitCode=exitCode, output=''.join(outputLines),
+    timedOut=False, runtime=time.time()-startTime)
+
+
+##############################################################################
+
+
+def runExecutable(args, stdinStr='', printCmdLine=False, streamOutput=False,
+timeout=None, tempFiles=None, outputPrefix='', lineCallback=None):
+    """
+    Runs program with parameters and returns the exit code and output as
+    a dictionary.
+
+    Args:
+        args: the program name and arguments as a string list
+        stdinStr: the string to be used as stdin input (you may have to add
+                  a newline to terminate)
+        printCmdLine: print the command line before running the program
+        streamOutput: echo the program output to the console while it is
+                      running
+        timeout: the maximum runtime in seconds, None for no limit
+        tempFiles: list of files to be removed when the program fails
+        outputPrefix: text put in front of each streamed output line
+        lineCallback: function called with each complete output line
+
+    Returns:
+        A SimpleNamespace as described for runExecutableAsync()
+    """
+
+    return runSynchronously(runExecutableAsync(args, stdinStr, printCmdLine,
+    streamOutput, timeout, tempFiles, outputPrefix, lineCallback))
+
+
+##############################################################################
+
+
+def printProgress(doneCount, totalCount, job, result):
+    """
+    Default progress report for concurrently running tools.
+
+    Args:
+        doneCount: the number of finished tools
+        totalCount: the total number of tools
+        job: the job description of the tool that finished
+        result: the result of the tool as returned by runExecutableAsync()
+    """
+
+    if result.timedOut:
+        status='timed out'
+    elif result.exitCode is None:
+        status='got cancelled'
+    else:
+        status='exited with code '+str(result.exitCode)
+
+    print('['+str(doneCount)+'/'+str(totalCount)+']',
+    job.get('name', os.path.basename(job['args'][0])), status, 'after',
+    int(result.runtime), 'seconds', flush=True)
+
+
+##############################################################################
+
+
+async def runExecutablesAsync(jobs, maxJobs=None, progress=printProgress,
+failFast=False):
+    """
+    Runs independent programs concurrently, with at most maxJobs of them at
+    the same time.
+
+    Args:
+        jobs: list of dictionaries with the keyword arguments of
+              runExecutableAsync() for each program, plus an optional
+              "name" to identify it in the progress report
+        maxJobs: the maximum number of programs running at the same time,
+                 defaults to the number of CPUs
+        progress: function called as progress(doneCount, totalCount, job,
+                  result) each time a program finishes, may be None
+        failFast: cancel the remaining programs as soon as one fails
+
+    Returns:
+        The list of results as returned by runExecutableAsync() in the order
+        of the jobs. Programs cancelled due to failFast have an exit code of
+        None.
+    """
+
+    semaphore=asyncio.Semaphore(max(1, maxJobs or os.cpu_count() or 1))
+    results=[None]*len(jobs)
+    doneCount=0
+
+    async def runJob(index, job):
+        nonlocal doneCount
+
+        async with semaphore:
+            kwargs={k: v for k, v in job.items() if k!='name'}
+
+            # keep concurrent output apart
+            if kwargs.get('streamOutput') and len(jobs)>1:
+                kwargs.setdefault('outputPrefix', '['+job.get('name',
+                str(index))+'] ')
+
+            result=await runExecutableAsync(**kwargs)
+
+        results[index]=result
+        doneCount+=1
+
+        if progress:
+            progress(doneCount, len(jobs), job, result)
+
+        if failFast and result.exitCode!=0:
+            raise FailFastError(job.get('name', job['args'][0])+' failed')
+
+    tasks=[asyncio.ensure_future(runJob(i, job)) for i, job in
+    enumerate(jobs)]
+
+    try:
+        await asyncio.gather(*tasks)
+    except FailFastError:
+        # fail fast: cancel all programs still running or waiting
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    return [result or SimpleNamespace(exitCode=None, output='',
+    timedOut=False, runtime=0) for result in results]
+
+
+##############################################################################
+
+
+def runExecutables(jobs, maxJobs=None, progress=printProgress,
+failFast=False):
+    """
+    Runs independent programs concurrently, see runExecutablesAsync().
+
+    Args:
+        jobs: list of dictionaries with the keyword arguments of
+              runExecutableAsync() for each program
+        maxJobs: the maximum number of programs running at the same time
+        progress: function called each time a program finishes, may be None
+        failFast: cancel the remaining programs as soon as one fails
+
+    Returns:
+        The list of results in the order of the jobs
+    """
+
+    return runSynchronously(runExecutablesAsync(jobs, maxJobs, progress,
+    failFast))